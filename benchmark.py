@@ -0,0 +1,446 @@
+from argparse import ArgumentParser
+import subprocess
+import asyncio
+import signal
+import random
+import socket
+import json
+import time
+import sys
+import os
+
+from main import config, packets
+
+# Default parameters of the simulated load and of the server launched for the benchmark.
+benchmark = {
+    "IP": "127.0.0.1",
+    "PORT": 0,
+
+    "ROBOTS": 500,
+    "CONCURRENCY": 100,
+    "AREA": 20,
+    "OBSTACLES": 0.05,
+    "RECHARGING": 0.01,
+    "RECHARGING_PAUSE": 0.1,
+    "MAX_COMMANDS": 500,
+    "LATENCY": 0,
+    "SEED": 2024,
+    "RESTART": None,
+    "PROBE_INTERVAL": 0.01,
+
+    "SERVER_START_TIMEOUT": 10,
+    "SERVER_STOP_TIMEOUT": 10
+}
+
+# Commands of the server as the simulated client-robots receive them (without PROTOCOL_TAG).
+commands = {name: packet[:-len(config["PROTOCOL_TAG"])] for name, packet in packets["server"].items()}
+
+# Moves of a client-robot on the map for each orientation ("UP", "RIGHT", "DOWN", "LEFT").
+steps = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+
+# Messages for the user interface of the benchmark.
+ui = {
+    "engine": "--- Benchmarking engine: {engine}, workers: {workers} ---",
+    "report": [
+        "sessions:          {sessions} ({failed} failed)",
+        "duration:          {duration:.2f} s",
+        "sessions/sec:      {sessions_per_second:.1f}",
+        "commands/session:  {commands_per_session:.1f}",
+        "round trip p50:    {rtt_p50:.3f} ms",
+        "round trip p90:    {rtt_p90:.3f} ms",
+        "round trip p99:    {rtt_p99:.3f} ms",
+        "session p50:       {session_p50:.1f} ms",
+        "session p99:       {session_p99:.1f} ms",
+        "server peak RSS:   {peak_rss:.1f} MiB",
+        "server CPU time:   {cpu_per_session:.3f} ms/session"
+    ],
+    "restart": "restart downtime:  {restart_downtime:.1f} ms ({failed_probes} of {probes} probes failed)",
+    "no restart": "restart downtime:  not measured, the robots finished before the restart"
+}
+
+
+# Exception describing the unexpected behaviour of the server from the point of view of a simulated client-robot.
+class SimulationException(Exception): pass
+
+
+# Simulated world shared by all client-robots of one benchmark: the obstacles on the map and the generator
+# of the initial positions and orientations of the robots.
+class SimulatedWorld:
+    def __init__(self, area, obstacles_density, seed):
+        self.area = area
+        self.random = random.Random(seed)
+        self.obstacles = {(x, y) for x in range(-area, area + 1) for y in range(-area, area + 1)
+                          if (x, y) != tuple(config["GIFT"]) and self.random.random() < obstacles_density}
+
+    # Choosing a random free position and a random orientation for a new client-robot.
+    def place_robot(self):
+        while True:
+            position = (self.random.randint(-self.area, self.area), self.random.randint(-self.area, self.area))
+            if position not in self.obstacles: return position, self.random.randrange(len(steps))
+
+
+# Simulation of one client-robot: it authenticates itself with one of the keys, executes the commands
+# of the server on the simulated map, optionally pauses for recharging and sends its packets fragmented
+# or pipelined. With LATENCY, every packet is delivered that many seconds after it is sent (by a separate task,
+# keeping their order), simulating a slow link. The time between sending a packet and receiving the next command
+# of the server is recorded as the round trip of the command, and the duration of the whole session.
+class RobotSimulator:
+    def __init__(self, robot_number, world, port, settings):
+        self.world = world
+        self.port = port
+        self.settings = settings
+        self.random = random.Random(settings["SEED"] + robot_number)
+
+        self.robot_username = f"Robot no. {robot_number}"[:packets["length"]["CLIENT_USERNAME"] - 2]
+        self.robot_keyid = self.random.randrange(len(config["AUTH_KEYS"]))
+        self.robot_position, self.robot_orientation = world.place_robot()
+
+        self.robot_reader = self.robot_writer = None
+        self.delayed_packets = self.delayed_sender = None
+        self.sent_at = None
+        self.commands = 0
+        self.round_trips = []
+        self.duration = None
+
+    # Sending the packets to the server, either in one write (pipelined), or split into random fragments,
+    # right away or after the latency of the link.
+    async def _send_packets(self, *robot_packets):
+        data = b"".join(packet.encode() + config["PROTOCOL_TAG"].encode() for packet in robot_packets)
+
+        if self.delayed_packets is not None: self.delayed_packets.put_nowait((time.perf_counter(), data))
+        else: await self._write_data(data)
+        self.sent_at = time.perf_counter()
+
+    # Delivering the delayed packets in the order they were sent, each once the latency of the link passed.
+    async def _send_delayed_packets(self):
+        while True:
+            sent_at, data = await self.delayed_packets.get()
+            await asyncio.sleep(sent_at + self.settings["LATENCY"] - time.perf_counter())
+            await self._write_data(data)
+
+    # Writing the data to the connection, split into random fragments if configured.
+    async def _write_data(self, data):
+        if self.settings["FRAGMENTED"]:
+            while data:
+                fragment_length = self.random.randint(1, len(data))
+                self.robot_writer.write(data[:fragment_length])
+                await self.robot_writer.drain()
+                data = data[fragment_length:]
+        else:
+            self.robot_writer.write(data)
+            await self.robot_writer.drain()
+
+    # Receiving the next command of the server and recording the round trip.
+    async def _receive_command(self):
+        command = await self.robot_reader.readuntil(config["PROTOCOL_TAG"].encode())
+        if self.sent_at is not None: self.round_trips.append(time.perf_counter() - self.sent_at)
+
+        return command[:-len(config["PROTOCOL_TAG"])]
+
+    # Replying to a command with the position, after recharging with the configured probability.
+    async def _send_position(self):
+        position = f"{config['POSITION_TAG']} {self.robot_position[0]} {self.robot_position[1]}"
+        if self.random.random() >= self.settings["RECHARGING"]: return await self._send_packets(position)
+
+        await self._send_packets(packets["robot"]["CLIENT_RECHARGING"])
+        await asyncio.sleep(self.settings["RECHARGING_PAUSE"])
+        await self._send_packets(packets["robot"]["CLIENT_FULL_POWER"], position)
+
+    # Authentication of the client-robot, checking the hash of the server.
+    async def _authenticate(self):
+        base_hash = (sum(map(ord, self.robot_username)) * 1000) % config["MOD"]
+        server_key, robot_key = config["AUTH_KEYS"][self.robot_keyid]
+
+        if self.settings["PIPELINED"]: await self._send_packets(self.robot_username, str(self.robot_keyid))
+        else: await self._send_packets(self.robot_username)
+        if await self._receive_command() != commands["SERVER_KEY_REQUEST"]: raise SimulationException()
+        if not self.settings["PIPELINED"]: await self._send_packets(str(self.robot_keyid))
+
+        if int(await self._receive_command()) != (base_hash + server_key) % config["MOD"]: raise SimulationException()
+        await self._send_packets(str((base_hash + robot_key) % config["MOD"]))
+        if await self._receive_command() != commands["SERVER_OK"]: raise SimulationException()
+
+    # Executing the commands of the server on the map until the message is picked up.
+    async def _search(self):
+        while self.commands < self.settings["MAX_COMMANDS"]:
+            command = await self._receive_command()
+            self.commands += 1
+
+            if command == commands["SERVER_MOVE"]:
+                step = steps[self.robot_orientation]
+                next_position = (self.robot_position[0] + step[0], self.robot_position[1] + step[1])
+                if next_position not in self.world.obstacles: self.robot_position = next_position
+            elif command == commands["SERVER_TURN_LEFT"]: self.robot_orientation = (self.robot_orientation - 1) % 4
+            elif command == commands["SERVER_TURN_RIGHT"]: self.robot_orientation = (self.robot_orientation + 1) % 4
+            elif command == commands["SERVER_PICK_UP"]:
+                if self.robot_position != tuple(config["GIFT"]): raise SimulationException()
+                await self._send_packets(f"Secret of {self.robot_username}")
+                return await self._receive_command() == commands["SERVER_LOGOUT"]
+            else: raise SimulationException()
+
+            await self._send_position()
+
+        return False
+
+    # The whole session of the client-robot, returning whether it ended with the message picked up.
+    async def simulate(self):
+        started_at = time.perf_counter()
+        try:
+            self.robot_reader, self.robot_writer = \
+                await asyncio.open_connection(self.settings["IP"], self.port)
+            if self.settings["LATENCY"]:
+                self.delayed_packets = asyncio.Queue()
+                self.delayed_sender = asyncio.create_task(self._send_delayed_packets())
+
+            await self._authenticate()
+            return await self._search()
+
+        except (SimulationException, ValueError, OSError, asyncio.IncompleteReadError): return False
+        finally:
+            self.duration = time.perf_counter() - started_at
+            if self.delayed_sender is not None: self.delayed_sender.cancel()
+            if self.robot_writer is not None: self.robot_writer.close()
+
+
+# Probe of the availability of the server during a restart: it connects again and again, sending a username
+# and waiting for the key request, and records when every probe started, how long it waited and whether
+# it was served. The longest wait of a probe is the downtime of the restart as the clients see it.
+class ServerProbe:
+    def __init__(self, port, settings):
+        self.port = port
+        self.settings = settings
+        self.probes = []
+
+    # One probe of the server, returning whether it was served.
+    async def _probe_server(self):
+        probe_writer = None
+        try:
+            probe_reader, probe_writer = await asyncio.open_connection(self.settings["IP"], self.port)
+            probe_writer.write(f"Probe{config['PROTOCOL_TAG']}".encode())
+            probe_reply = await probe_reader.readuntil(config["PROTOCOL_TAG"].encode())
+            return probe_reply[:-len(config["PROTOCOL_TAG"])] == commands["SERVER_KEY_REQUEST"]
+
+        except (OSError, asyncio.IncompleteReadError): return False
+        finally:
+            if probe_writer is not None: probe_writer.close()
+
+    # Probing the server every PROBE_INTERVAL seconds until the task is cancelled.
+    async def run(self):
+        while True:
+            started_at = time.perf_counter()
+            served = await self._probe_server()
+            self.probes.append((started_at, time.perf_counter() - started_at, served))
+            await asyncio.sleep(benchmark["PROBE_INTERVAL"])
+
+
+# Runner of the benchmark: for every requested engine it launches the real server (main.py) as a separate
+# process listening on the loopback, drives it with the simulated client-robots and reports sessions per second,
+# percentiles of the round trip of the commands and the peak RSS of the server process (and its workers).
+# With RESTART, the server is restarted (SIGHUP) that many seconds into the run, while a probe measures
+# the downtime of the restart.
+class BenchmarkRunner:
+    def __init__(self, settings):
+        self.settings = settings
+
+    # Launching the server with the configuration of the benchmark and waiting until it accepts connections.
+    def _launch_server(self, engine, port):
+        server_config = {"IP": self.settings["IP"], "PORT": port, "ENGINE": engine,
+                         "WORKERS": self.settings["WORKERS"], **self.settings["SERVER_CONFIG"]}
+        server_code = "import json, sys, main; main.config.update(json.loads(sys.argv[1])); main.Server().launch()"
+        server_process = subprocess.Popen([sys.executable, "-c", server_code, json.dumps(server_config)],
+                                          cwd=os.path.dirname(os.path.abspath(__file__)), start_new_session=True,
+                                          stdout=subprocess.DEVNULL if self.settings["QUIET"] else None)
+
+        deadline = time.monotonic() + benchmark["SERVER_START_TIMEOUT"]
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection((self.settings["IP"], port), timeout=1):
+                    return server_process
+            except OSError: time.sleep(0.05)
+
+        server_process.kill()
+        raise RuntimeError("The server did not start accepting connections.")
+
+    # Identifiers of the living processes of the server: its worker processes and the servers replacing it
+    # on restarts stay in the process group of the server.
+    def _get_server_processes(self, server_pid):
+        process_ids = []
+        for process_id in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                with open(f"/proc/{process_id}/stat") as stat: process_state = stat.read().rsplit(")", 1)[1].split()
+            except OSError: continue
+            if process_state[0] != "Z" and int(process_state[2]) == server_pid: process_ids.append(process_id)
+
+        return process_ids
+
+    # Peak resident set size of the server process and all its worker processes, in MiB.
+    def _measure_server_memory(self, server_pid):
+        peak_rss = 0
+        for process_id in self._get_server_processes(server_pid):
+            try:
+                with open(f"/proc/{process_id}/status") as status:
+                    peak_rss += sum(int(line.split()[1]) for line in status if line.startswith("VmHWM:"))
+            except OSError: pass
+
+        return peak_rss / 1024
+
+    # CPU time (user and system) consumed so far by the server process and all its worker processes, in seconds.
+    def _measure_server_cpu(self, server_pid):
+        cpu_ticks = 0
+        for process_id in self._get_server_processes(server_pid):
+            try:
+                with open(f"/proc/{process_id}/stat") as stat: process_stat = stat.read().rsplit(")", 1)[1].split()
+            except OSError: continue
+
+            cpu_ticks += int(process_stat[11]) + int(process_stat[12])
+
+        return cpu_ticks / os.sysconf("SC_CLK_TCK")
+
+    # Interrupting the server (and its workers, or the server which replaced it) as on Ctrl+C and waiting until
+    # all its processes end, killing them if they do not end in time.
+    def _stop_server(self, server_process):
+        try: os.killpg(server_process.pid, signal.SIGINT)
+        except ProcessLookupError: pass
+
+        deadline = time.monotonic() + benchmark["SERVER_STOP_TIMEOUT"]
+        try: server_process.wait(benchmark["SERVER_STOP_TIMEOUT"])
+        except subprocess.TimeoutExpired: pass
+        while self._get_server_processes(server_process.pid) and time.monotonic() < deadline: time.sleep(0.05)
+
+        try: os.killpg(server_process.pid, signal.SIGKILL)
+        except ProcessLookupError: pass
+        server_process.wait()
+
+    # Driving the server with all simulated client-robots, at most CONCURRENCY of them at the same time.
+    # With RESTART, the server is restarted during the run, and the time of the restart is returned with
+    # the results (None if the robots finished first).
+    async def _simulate_robots(self, server_pid, server_probe):
+        world = SimulatedWorld(self.settings["AREA"], self.settings["OBSTACLES"], self.settings["SEED"])
+        concurrency = asyncio.Semaphore(self.settings["CONCURRENCY"])
+        robots = [RobotSimulator(robot_number, world, server_probe.port, self.settings)
+                  for robot_number in range(self.settings["ROBOTS"])]
+        restarted_at = []
+
+        async def simulate(robot):
+            async with concurrency: return await robot.simulate()
+
+        def restart_server():
+            os.kill(server_pid, signal.SIGHUP)
+            restarted_at.append(time.perf_counter())
+
+        restart_timer = probe_task = None
+        if self.settings["RESTART"] is not None:
+            restart_timer = asyncio.get_running_loop().call_later(self.settings["RESTART"], restart_server)
+            probe_task = asyncio.create_task(server_probe.run())
+
+        results = await asyncio.gather(*(simulate(robot) for robot in robots))
+        if restart_timer is not None: restart_timer.cancel(), probe_task.cancel()
+        return robots, results, restarted_at[0] if restarted_at else None
+
+    # Downtime of the restart of the server: the longest wait of a probe started after the restart
+    # (and the probes which failed), or None if the server was not restarted.
+    def _measure_restart(self, server_probe, restarted_at):
+        if restarted_at is None: return None
+
+        probes = [(wait, served) for started_at, wait, served in server_probe.probes if started_at >= restarted_at]
+        return {
+            "restart_downtime": max((wait * 1000 for wait, _ in probes), default=0),
+            "probes": len(probes), "failed_probes": sum(not served for _, served in probes)
+        }
+
+    # Finding a free port for the server, as the port of the previous run may still be held by connections
+    # in the TIME_WAIT state.
+    def _find_free_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as free_socket:
+            free_socket.bind((self.settings["IP"], 0))
+            return free_socket.getsockname()[1]
+
+    # Benchmarking one engine and returning its report.
+    def _benchmark_engine(self, engine, port):
+        server_process, server_probe = self._launch_server(engine, port), ServerProbe(port, self.settings)
+        try:
+            started_at, started_cpu = time.perf_counter(), self._measure_server_cpu(server_process.pid)
+            robots, results, restarted_at = asyncio.run(self._simulate_robots(server_process.pid, server_probe))
+            duration = time.perf_counter() - started_at
+            server_cpu = self._measure_server_cpu(server_process.pid) - started_cpu
+            peak_rss = self._measure_server_memory(server_process.pid)
+        finally: self._stop_server(server_process)
+
+        round_trips = sorted(round_trip * 1000 for robot in robots for round_trip in robot.round_trips) or [0]
+        percentile = lambda p: round_trips[min(len(round_trips) - 1, int(len(round_trips) * p / 100))]
+        finished = [robot for robot, result in zip(robots, results) if result]
+        durations = sorted(robot.duration * 1000 for robot in finished) or [0]
+        session_percentile = lambda p: durations[min(len(durations) - 1, int(len(durations) * p / 100))]
+
+        return {
+            "engine": engine, "workers": self.settings["WORKERS"],
+            "sessions": len(robots), "failed": len(robots) - len(finished), "duration": duration,
+            "sessions_per_second": len(finished) / duration,
+            "commands_per_session": sum(robot.commands for robot in finished) / max(len(finished), 1),
+            "rtt_p50": percentile(50), "rtt_p90": percentile(90), "rtt_p99": percentile(99),
+            "session_p50": session_percentile(50), "session_p99": session_percentile(99),
+            "peak_rss": peak_rss, "cpu_per_session": server_cpu * 1000 / len(robots),
+            "restart": self._measure_restart(server_probe, restarted_at)
+        }
+
+    # Running the benchmark of all requested engines, printing the reports and optionally appending them
+    # as JSON lines to a file to track them across commits.
+    def run(self):
+        reports = []
+        for engine in self.settings["ENGINES"]:
+            print(ui["engine"].format(engine=engine, workers=self.settings["WORKERS"]))
+            report = self._benchmark_engine(engine, self.settings["PORT"] or self._find_free_port())
+            report_lines = [line.format(**report) for line in ui["report"]]
+            if report["restart"]: report_lines.append(ui["restart"].format(**report["restart"]))
+            elif self.settings["RESTART"] is not None: report_lines.append(ui["no restart"])
+            print("\n".join(report_lines) + "\n")
+            reports.append(report)
+
+        if self.settings["JSON"]:
+            with open(self.settings["JSON"], "a") as json_file:
+                for report in reports: json_file.write(json.dumps({**report, "time": time.time()}) + "\n")
+
+        return reports
+
+
+# Parsing the parameters of the benchmark from the command line.
+def parse_settings(arguments=None):
+    parser = ArgumentParser(description="Load-generating robot simulator and benchmark of the robot server.")
+    parser.add_argument("--engine", dest="ENGINES", nargs="+", default=["thread"], choices=["thread", "asyncio"])
+    parser.add_argument("--workers", dest="WORKERS", type=int, default=1)
+    parser.add_argument("--ip", dest="IP", default=benchmark["IP"])
+    parser.add_argument("--port", dest="PORT", type=int, default=benchmark["PORT"],
+                        help="port of the server (a free port is chosen by default)")
+    parser.add_argument("--robots", dest="ROBOTS", type=int, default=benchmark["ROBOTS"])
+    parser.add_argument("--concurrency", dest="CONCURRENCY", type=int, default=benchmark["CONCURRENCY"])
+    parser.add_argument("--area", dest="AREA", type=int, default=benchmark["AREA"],
+                        help="robots start at coordinates between -AREA and AREA")
+    parser.add_argument("--obstacles", dest="OBSTACLES", type=float, default=benchmark["OBSTACLES"],
+                        help="probability of an obstacle on each cell of the area")
+    parser.add_argument("--recharging", dest="RECHARGING", type=float, default=benchmark["RECHARGING"],
+                        help="probability of recharging before replying to a command")
+    parser.add_argument("--recharging-pause", dest="RECHARGING_PAUSE", type=float,
+                        default=benchmark["RECHARGING_PAUSE"])
+    parser.add_argument("--max-commands", dest="MAX_COMMANDS", type=int, default=benchmark["MAX_COMMANDS"])
+    parser.add_argument("--latency", dest="LATENCY", type=float, default=benchmark["LATENCY"],
+                        help="seconds every packet of the robots takes to reach the server")
+    parser.add_argument("--fragmented", dest="FRAGMENTED", action="store_true",
+                        help="send every packet split into random fragments")
+    parser.add_argument("--pipelined", dest="PIPELINED", action="store_true",
+                        help="send the username and the key id in one write")
+    parser.add_argument("--seed", dest="SEED", type=int, default=benchmark["SEED"])
+    parser.add_argument("--restart", dest="RESTART", type=float, default=benchmark["RESTART"],
+                        help="restart the server (SIGHUP) this many seconds into the run and measure the downtime")
+    parser.add_argument("--set", dest="SERVER_CONFIG", action="append", default=[], metavar="KEY=JSON",
+                        help="override a value of the server configuration")
+    parser.add_argument("--json", dest="JSON", help="append the reports as JSON lines to this file")
+    parser.add_argument("--verbose", dest="QUIET", action="store_false", help="show the output of the server")
+
+    settings = vars(parser.parse_args(arguments))
+    settings["SERVER_CONFIG"] = {key: json.loads(value) for key, value in
+                                 (override.split("=", 1) for override in settings["SERVER_CONFIG"])}
+    return settings
+
+
+if __name__ == '__main__':
+    BenchmarkRunner(parse_settings()).run()
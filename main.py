@@ -1,6 +1,23 @@
-from threading import Thread
+from threading import Thread, Lock
+from collections import deque
+from functools import lru_cache
+from queue import Queue, Full
+from bisect import bisect_left
+import importlib
+import select
+import signal
+import heapq
+import json
+import struct
+import mmap
+import time
+import os
+import sys
 import socket
 
+# Modules needed only by some configurations of the server, imported when first needed (see import_lazily).
+argparse = asyncio = http = multiprocessing = subprocess = tomllib = None
+
 # Configuration constants for various aspects of the server's operations.
 config = {
     "IP": "bursasha",
@@ -8,8 +25,25 @@ config = {
 
     "PROTOCOL_TAG": "\a\b",
 
+    "ENGINE": "thread",
+    "WORKERS": 1,
+    "REUSE_PORT": True,
+    "WORKERS_SHUTDOWN_TIMEOUT": 5,
+    "WORKERS_RESTART_DELAY": 0.5,
+    "WORKERS_RESTART_WINDOW": 60,
+    "WORKERS_RESTART_LIMIT": 5,
+    "DRAIN_TIMEOUT": 5,
+    "RESTART_TIMEOUT": 10,
+
+    "BACKLOG": 128,
+    "MAX_SESSIONS": 256,
+    "ACCEPT_QUEUE": 1024,
+    "OVERLOAD": "queue",
+
     "TIMEOUT": 1,
     "TIMEOUT_RECHARGING": 5,
+    "TIMER_RESOLUTION": 0.05,
+    "TIMER_SLOTS": 256,
 
     "AUTH_KEYS": {
         0: [23019, 32037],
@@ -19,8 +53,33 @@ config = {
         4: [18189, 21952]
     },
     "MOD": 65536,
+    "AUTH_KEYS_FILE": "",
+    "AUTH_KEYS_RELOAD_INTERVAL": 1,
+    "AUTH_HASH_CACHE": 4096,
 
     "POSITION_TAG": "OK",
+    "PIPELINE": 1,
+
+    "TCP_NODELAY": True,
+    "TCP_CORK": False,
+    "RECV_BUFFER": 0,
+    "SEND_BUFFER": 0,
+
+    "LOG_LEVEL": "DEBUG",
+    "LOG_FORMAT": "text",
+    "LOG_QUEUE_SIZE": 65536,
+    "LOG_OVERFLOW": "drop",
+    "LOG_BATCH_SIZE": 1024,
+    "LOG_FLUSH_INTERVAL": 0.05,
+
+    "STATS_IP": "127.0.0.1",
+    "STATS_PORT": 0,
+
+    "OBSTACLES_CACHE": 0,
+    "OBSTACLES_CACHE_PROBES": 4,
+
+    "RECORD_DIR": "",
+    "RECORD_FILE_SIZE": 64 * 1024 * 1024,
 
     "GIFT": [0,0]
 }
@@ -66,7 +125,10 @@ errors = {
     "AUTH_KEYS": "AUTHENTICATION KEYS ERROR!",
     "LOGIN": "LOGIN ERROR!",
     "SYNTAX": "SYNTAX ERROR!",
-    "LOGIC": "LOGIC ERROR!"
+    "LOGIC": "LOGIC ERROR!",
+    "CONNECTION": "CONNECTION CLOSED ERROR!",
+    "SHUTDOWN": "SERVER SHUTDOWN!",
+    "SERVER": "SERVER ERROR!"
 }
 
 # Messages for the user interface of the program launched in the console.
@@ -96,346 +158,1941 @@ ui = {
     ],
 
     "server": [
-        f"    ### Server launched ###\n%%% IP: {config['IP']}, PORT: {config['PORT']} %%%",
-        "    ### Server shut down ###"
+        "    ### Server launched ###",
+        "    ### Server shut down ###",
+        "    ### Server draining ###",
+        "    ### Server restarting ###",
+        "    ### Server restart failed ###"
     ],
 
-    "recharge": "- +++ started recharging +++."
-}
-
-# All possible orientations in map space for each client-robot.
-orientation = ["UP", "RIGHT", "DOWN", "LEFT"]
-
-
-# Classes describing all possible exceptions that occur during the server's operations with clients.
-class TimeoutException(Exception):
-    def __init__(self): self.message = errors["TIMEOUT"]
+    "worker": [
+        "    ### Worker launched ###",
+        "    ### Worker died, restarting ###",
+        "    ### Worker shut down ###",
+        "    ### Worker keeps dying, shutting down ###"
+    ],
 
-class AuthKeysException(Exception):
-    def __init__(self): self.message = errors["AUTH_KEYS"]
+    "keys": [
+        "    ### Auth keys loaded ###",
+        "    ### Auth keys not reloaded ###"
+    ],
 
-class LoginException(Exception):
-    def __init__(self): self.message = errors["LOGIN"]
+    "cache": "    ### Obstacles cache ###",
 
-class LogicException(Exception):
-    def __init__(self): self.message = errors["LOGIC"]
+    "record": "    ### Sessions recorded ###",
 
-class SyntaxException(Exception):
-    def __init__(self): self.message = errors["SYNTAX"]
+    "stats": "    ### Stats launched ###",
 
+    "log": "    ### Log records dropped ###",
 
-# Class engine that implements the main functionality of any server - receiving data from the client
-# and sending data back to the client. For the convenience of working with sockets, address,
-# and client packets stream, 3 corresponding class variables are created.
-class ServerEngine:
-    def __init__(self, robot_socket, robot_address):
-        self.robot_socket = robot_socket
-        self.robot_address = robot_address
-        self.robot_packets_queue = ""
+    "error": "-",
 
-    # This function implements the receiving of packets sent from the client. The main logic involves
-    # an inner loop that uses the settimeout() function to determine the maximum time delay for receiving a packet.
-    # If the delay exceeds the limit, the connection with the robot client is terminated. Otherwise, the received
-    # packet part is placed in a "packet queue" (not exceeding the maximum length of the packet for that specific type),
-    # and then, when possible, a complete packet
-    # (containing PROTOCOL_TAG \a\b) will be retrieved from the queue and checked for allowable length.
-    def _receive_packet(self, packet_length, timeout):
-        packet_is_ready = config["PROTOCOL_TAG"] in self.robot_packets_queue
-        packet_length = max(packet_length, packets["length"]["CLIENT_RECHARGING"])
+    "overload": "- rejected, the server is overloaded!",
 
-        while True:
-            if not packet_is_ready:
-                try:
-                    self.robot_socket.settimeout(timeout)
-                    packet_buffer = self.robot_socket.recv(packet_length).decode()
-                    self.robot_packets_queue += packet_buffer
-
-                except socket.timeout: raise TimeoutException()
+    "recharge": "- +++ started recharging +++."
+}
 
-            packet_part = self.robot_packets_queue.find(config["PROTOCOL_TAG"])
-            if packet_part == -1:
-                if len(self.robot_packets_queue) > packet_length - len(config["PROTOCOL_TAG"]): raise SyntaxException()
-                else: continue
+# Verbosity levels of the log: every protocol step is logged at DEBUG, the start and the end of every session
+# at INFO and the errors terminating a session at WARNING.
+log_levels = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "OFF": 100}
+
+# Checks of the settings given on the command line or in a configuration file (see validate_config): every setting
+# takes a value of the type of its default, except for the durations in seconds taking any number and the addresses
+# and ports to listen on taking lists too. Numbers must not be negative (nor zero for the positive settings)
+# and the settings with a fixed set of values must take one of them. The fixed settings are used as soon as the server
+# is imported (PROTOCOL_TAG ends all the packets above), so they cannot be changed.
+config_types = {**{key: (type(value),) for key, value in config.items()},
+                **{key: (int, float) for key in ("WORKERS_SHUTDOWN_TIMEOUT", "WORKERS_RESTART_DELAY",
+                                                 "WORKERS_RESTART_WINDOW", "DRAIN_TIMEOUT", "RESTART_TIMEOUT",
+                                                 "TIMEOUT", "TIMEOUT_RECHARGING", "TIMER_RESOLUTION",
+                                                 "AUTH_KEYS_RELOAD_INTERVAL", "LOG_FLUSH_INTERVAL")},
+                "IP": (str, list), "PORT": (int, list)}
+config_positive = {"WORKERS", "MAX_SESSIONS", "TIMEOUT", "TIMEOUT_RECHARGING", "TIMER_RESOLUTION", "TIMER_SLOTS", "MOD",
+                   "PIPELINE", "LOG_QUEUE_SIZE", "LOG_BATCH_SIZE", "LOG_FLUSH_INTERVAL", "OBSTACLES_CACHE_PROBES",
+                   "RECORD_FILE_SIZE"}
+config_fixed = {"PROTOCOL_TAG"}
+config_choices = {"ENGINE": ["thread", "asyncio"], "OVERLOAD": ["queue", "reject", "delay"],
+                  "LOG_LEVEL": list(log_levels), "LOG_FORMAT": ["text", "json"], "LOG_OVERFLOW": ["drop", "block"]}
+
+# Metrics of the server exposed in the Prometheus text format by the stats interface:
+# histograms with the upper bounds of their buckets and counters with the values of their label.
+metrics = {
+    "robot_command_round_trip_seconds": ("histogram", "Time from sending a packet to a robot to receiving its reply.",
+                                         [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]),
+    "robot_authentication_seconds": ("histogram", "Duration of the authentication stage of a session.",
+                                     [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]),
+    "robot_search_seconds": ("histogram", "Duration of the search stage of a session, up to the logout.",
+                             [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]),
+    "robot_recharging_seconds": ("histogram", "Time a robot spent recharging.", [0.1, 0.25, 0.5, 1, 2, 3, 4, 5]),
+    "robot_session_seconds": ("histogram", "Duration of a whole session, from the connection to its closing.",
+                              [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]),
+    "robot_session_commands": ("histogram", "Moves and turns sent to a robot during the search stage.",
+                               [5, 10, 20, 30, 50, 75, 100, 200, 500]),
+    "robot_sessions_total": ("counter", "Closed sessions by the way they ended.",
+                             ["success", "TimeoutException", "AuthKeysException", "LoginException",
+                              "LogicException", "SyntaxException", "ConnectionException", "ShutdownException",
+                              "ServerError"]),
+    "robot_connections_total": ("counter", "Accepted connections by their admission: served by an idle thread "
+                                           "(task) at once, queued until one is free, or rejected as the server "
+                                           "is overloaded.",
+                                ["served", "queued", "rejected"]),
+    "robot_obstacles_cache_lookups_total": ("counter", "Lookups of cells in the obstacles cache, by whether the cell "
+                                                       "was a known obstacle.", ["hit", "miss"]),
+    "robot_sessions_waiting": ("gauge", "Sessions waiting for a packet from their robot, by the state of the session.",
+                               ["AUTH_USERNAME", "AUTH_KEY_ID", "AUTH_CONFIRMATION", "SEARCH", "RECHARGE", "PICKUP"])
+}
 
-            packet = self.robot_packets_queue[:packet_part + len(config["PROTOCOL_TAG"])]
-            if not packet or len(packet) > packet_length: raise SyntaxException()
+# Events of a session written by the session recorder, with the data each of them carries.
+record_events = {
+    "OPENED": 0,    # the address of the client-robot, "ip:port"
+    "RECEIVED": 1,  # a part of the stream received from the client-robot, as received
+    "SENT": 2,      # the packets sent to the client-robot at once
+    "CLOSED": 3,    # the way the session ended, "success" or the exception type
+    "CACHED": 4     # the numbers of the lookups of the obstacles cache finding an obstacle while a route was planned
+}
 
-            self.robot_packets_queue = self.robot_packets_queue[packet_part + len(config["PROTOCOL_TAG"]):]
+# State machine of a session: every state with the packet the server expects from the client-robot in it,
+# the timeout of receiving that packet, the handler of the packet (see ConnectionMechanism) and the state following
+# once the handler completes the state (None ending the session). RECHARGE is entered from any state
+# on CLIENT_RECHARGING and left back to that state on CLIENT_FULL_POWER (see ServerEngine.process_packet), so it has
+# no handler of its own. The maximum lengths, timeouts and handlers are resolved once
+# (see ConnectionMechanism.configure).
+session_states = {
+    "AUTH_USERNAME": ("CLIENT_USERNAME", "TIMEOUT", "_process_username", "AUTH_KEY_ID"),
+    "AUTH_KEY_ID": ("CLIENT_KEY_ID", "TIMEOUT", "_process_keyid", "AUTH_CONFIRMATION"),
+    "AUTH_CONFIRMATION": ("CLIENT_CONFIRMATION", "TIMEOUT", "_process_robot_hash", "SEARCH"),
+    "SEARCH": ("CLIENT_OK", "TIMEOUT", "_process_robot_position", "PICKUP"),
+    "RECHARGE": ("CLIENT_FULL_POWER", "TIMEOUT_RECHARGING", None, None),
+    "PICKUP": ("CLIENT_MESSAGE", "TIMEOUT", "_process_gift_message", None)
+}
 
-            return packet.replace(config["PROTOCOL_TAG"], "")
+# All possible orientations in map space for each client-robot and the corresponding steps on the map.
+orientation = ["UP", "RIGHT", "DOWN", "LEFT"]
+orientation_steps = [(0, 1), (1, 0), (0, -1), (-1, 0)]
 
-    # Function for convenient processing of the received packet for the presence of data on the client-robot's recharge
-    # and the next mandatory received packet with data on the full robot charge, as well as checking
-    # for a logical error in 2 possible places - without receiving a recharge packet and 5 seconds after receiving it.
-    def process_packet(self, packet_length, timeout):
-        processed_packet = self._receive_packet(packet_length, timeout)
 
-        if processed_packet == packets["robot"]["CLIENT_FULL_POWER"]: raise LogicException()
-        if processed_packet == packets["robot"]["CLIENT_RECHARGING"]:
-            print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['recharge']}")
-            processed_packet = \
-                self._receive_packet(packets["length"]["CLIENT_FULL_POWER"], config["TIMEOUT_RECHARGING"])
-            if processed_packet != packets["robot"]["CLIENT_FULL_POWER"]: raise LogicException()
-            else: return self.process_packet(packet_length, timeout)
+# Classes describing all possible exceptions that occur during the server's operations with clients.
+# Each exception carries the message for the console and the packet (if any) sent to the client-robot
+# before the connection is closed.
+class RobotException(Exception):
+    def __init__(self, message, packet=None): self.message, self.packet = message, packet
 
-        return processed_packet
+class TimeoutException(RobotException):
+    def __init__(self): super().__init__(errors["TIMEOUT"])
 
-    # Function responsible for sending the ready packet to the client-robot.
-    def send_packet(self, packet): self.robot_socket.send(packet)
+class AuthKeysException(RobotException):
+    def __init__(self): super().__init__(errors["AUTH_KEYS"], packets["server"]["SERVER_KEY_OUT_OF_RANGE_ERROR"])
 
+class LoginException(RobotException):
+    def __init__(self): super().__init__(errors["LOGIN"], packets["server"]["SERVER_LOGIN_FAILED"])
 
-# Class implementing the mechanism of client-robot authentication on the server. Inherits functionality from
-# the engine class for working with client interactions. Corresponding class variables are created for
-# ease of working with data received from the client
-class AuthenticationMechanism(ServerEngine):
-    def __init__(self, robot_socket, robot_address):
-        super().__init__(robot_socket, robot_address)
-        self.robot_username = self.robot_keyid = self.robot_base_hash = None
+class LogicException(RobotException):
+    def __init__(self): super().__init__(errors["LOGIC"], packets["server"]["SERVER_LOGIC_ERROR"])
 
-    # Function responsible for obtaining the client's username and subsequently processing it into a hash code.
-    def _process_username(self):
-        self.robot_username = self.process_packet(packets["length"]["CLIENT_USERNAME"], config["TIMEOUT"])
+class SyntaxException(RobotException):
+    def __init__(self): super().__init__(errors["SYNTAX"], packets["server"]["SERVER_SYNTAX_ERROR"])
 
-        username_converted = []
-        for char in self.robot_username: username_converted.append(ord(char))
-        self.robot_base_hash = (sum(username_converted) * 1000) % config["MOD"]
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['auth'][1]} {self.robot_username}.")
+class ConnectionException(RobotException):
+    def __init__(self): super().__init__(errors["CONNECTION"])
 
-    # Function responsible for obtaining and processing the ID of the required key for authentication.
-    def _process_keyid(self):
-        self.send_packet(packets["server"]["SERVER_KEY_REQUEST"])
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['auth'][2]}")
+class ShutdownException(RobotException):
+    def __init__(self): super().__init__(errors["SHUTDOWN"], packets["server"]["SERVER_LOGOUT"])
 
-        keyid = self.process_packet(packets["length"]["CLIENT_KEY_ID"], config["TIMEOUT"])
-        if not keyid.isdigit(): raise SyntaxException()
-        if int(keyid) < 0 or int(keyid) > 4: raise AuthKeysException()
-        self.robot_keyid = int(keyid)
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['auth'][3]} {self.robot_keyid}.")
 
-    # Function responsible for generating the server hash code for the corresponding client confirmation.
-    def _process_server_hash(self):
-        server_hash = (self.robot_base_hash + config["AUTH_KEYS"][self.robot_keyid][0]) % config["MOD"]
-        self.send_packet((str(server_hash) + config["PROTOCOL_TAG"]).encode())
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['auth'][4]} {server_hash}.")
+# Incremental queue of the packets received from a client-robot, working on raw bytes. Received data is appended
+# to a bytearray, and the queue remembers both the start of the next packet and the offset up to which the data
+# was already scanned for PROTOCOL_TAG, so each byte is scanned only once however fragmented the stream is
+# (one byte back is rescanned, as the \a of the tag may arrive in the previous part). The maximum packet length is
+# enforced as soon as the data arrives, and only the complete packet is decoded. The class does not depend
+# on sockets, so it can be fuzzed and benchmarked on its own.
+class PacketsQueue:
+    __slots__ = ("packets_buffer", "packet_start", "scan_offset")
+    protocol_tag = config["PROTOCOL_TAG"].encode()
 
-    # Function for the server to receive the client hash code and verify its validity.
-    def _process_robot_hash(self):
-        robot_hash = self.process_packet(packets["length"]["CLIENT_CONFIRMATION"], config["TIMEOUT"])
-        if not robot_hash.isdigit() or len(robot_hash) > \
-                packets["length"]["CLIENT_CONFIRMATION"] - len(config["PROTOCOL_TAG"]): raise SyntaxException()
+    def __init__(self):
+        self.packets_buffer = bytearray()
+        self.packet_start = self.scan_offset = 0
+
+    # Appending the received part of the stream, dropping the already returned packets from the buffer first.
+    def put(self, packet_buffer):
+        if self.packet_start:
+            del self.packets_buffer[:self.packet_start]
+            self.scan_offset -= self.packet_start
+            self.packet_start = 0
+
+        self.packets_buffer += packet_buffer
+
+    # Returning the next complete packet without PROTOCOL_TAG, or None if it has not fully arrived yet.
+    # A packet (or its already received part) longer than packet_length is a syntax error.
+    def get_packet(self, packet_length):
+        tag_position = self.packets_buffer.find(self.protocol_tag, max(self.scan_offset - 1, self.packet_start))
+
+        if tag_position == -1:
+            self.scan_offset = len(self.packets_buffer)
+            unfinished_length = len(self.packets_buffer) - self.packet_start
+            if self.packets_buffer.endswith(self.protocol_tag[:1]): unfinished_length -= 1
+            if unfinished_length > packet_length - len(self.protocol_tag): raise SyntaxException()
+            return None
+
+        packet_end = tag_position + len(self.protocol_tag)
+        if packet_end - self.packet_start > packet_length: raise SyntaxException()
+
+        try: packet = self.packets_buffer[self.packet_start:tag_position].decode()
+        except UnicodeDecodeError: raise SyntaxException()
+
+        if packet_end == len(self.packets_buffer):
+            self.packets_buffer.clear()
+            self.packet_start = self.scan_offset = 0
+        else: self.packet_start = self.scan_offset = packet_end
+
+        return packet
+
+
+# Signals interrupting (SIGINT, SIGTERM) and restarting (SIGHUP) the server, handled by the main thread.
+server_signals = [getattr(signal, name) for name in ("SIGINT", "SIGTERM", "SIGHUP") if hasattr(signal, name)]
+
+
+# Starting a thread with the signals of the server blocked, so the kernel always delivers them to the main thread
+# and they interrupt its blocking calls (such as accept()) at once.
+def start_thread(target, daemon=False):
+    new_thread = Thread(target=target, daemon=daemon)
+    if not hasattr(signal, "pthread_sigmask"):
+        new_thread.start()
+        return new_thread
+
+    signals_mask = signal.pthread_sigmask(signal.SIG_BLOCK, server_signals)
+    try: new_thread.start()
+    finally: signal.pthread_sigmask(signal.SIG_SETMASK, signals_mask)
+    return new_thread
+
+
+# Waiting for connections on the listening sockets (in the non-blocking mode, as they may be shared with other
+# processes serving the ports) and accepting one from every socket ready, so no socket is starved by a busier one.
+# The signals of the server are deliverable only while waiting, so a signal interrupting the server never drops
+# a connection accepted but not yet admitted; they stay blocked after the call and pending ones are delivered
+# at the next call. Sockets of which another process accepted the connection first give no connection.
+def accept_connections(server_sockets):
+    signals_blockable = hasattr(signal, "pthread_sigmask")
+    if signals_blockable: signal.pthread_sigmask(signal.SIG_UNBLOCK, server_signals)
+    try: ready_sockets = select.select(server_sockets, [], [])[0]
+    finally:
+        if signals_blockable: signal.pthread_sigmask(signal.SIG_BLOCK, server_signals)
+
+    robot_connections = []
+    for server_socket in ready_sockets:
+        try: robot_connections.append(server_socket.accept())
+        except BlockingIOError: pass
+
+    return robot_connections
+
+
+# Delivering the signals of the server that are pending while they are blocked (see accept_connections), so their
+# handlers run now: the thread waiting for anything else than a connection can still be interrupted or restarted.
+def deliver_signals():
+    if not hasattr(signal, "pthread_sigmask"): return
+
+    try: signal.pthread_sigmask(signal.SIG_UNBLOCK, server_signals)
+    finally: signal.pthread_sigmask(signal.SIG_BLOCK, server_signals)
+
+
+# Importing the modules needed only by some configurations of the server (the asyncio engine, the worker processes,
+# the restart, the stats interface and the command line) when they are first needed, as globals of this module,
+# so the server (and its successor on a restart) starts without importing the others.
+def import_lazily(*module_names):
+    for module_name in module_names:
+        importlib.import_module(module_name)
+        package_name = module_name.partition(".")[0]
+        globals()[package_name] = sys.modules[package_name]
+
+
+# Logging pipeline of the server. Connection handlers never format or write anything themselves: each call
+# below the configured verbosity returns at once, and any other call appends a compact record (time, level,
+# robot address, stage of the ui table, values) to a bounded queue. The deque is appended to and popped
+# from atomically, so producers take no lock. A background writer thread drains the queue in batches,
+# formats the records as text lines or JSON objects and writes each batch to the standard output at once.
+# When the queue is full, new records are either dropped (and counted) or the producer waits for the writer.
+class RobotLogger:
+    def __init__(self):
+        self.log_records = deque()
+        self.configure()
+        self.dropped_records = 0
+        self.writer_thread = None
+        self.writer_running = False
+
+    # Starting the background writer. In a forked worker process the records inherited from the supervisor
+    # are discarded first, as the supervisor writes them itself.
+    def start(self, forked=False):
+        if forked: self.log_records = deque()
+        self.configure()
+        self.writer_running = True
+        self.writer_thread = start_thread(self._write_log_records, daemon=True)
+
+    # Applying the verbosity of the configuration, done by the server before it logs anything.
+    def configure(self): self.log_level = log_levels[config["LOG_LEVEL"]]
+
+    # Stopping the background writer after all queued records are written.
+    def stop(self):
+        self.writer_running = False
+        if self.writer_thread is not None: self.writer_thread.join()
+
+    def debug(self, robot_address, stage, index=None, *values):
+        if self.log_level <= 10: self._put_log_record(10, robot_address, stage, index, values)
+
+    def info(self, robot_address, stage, index=None, *values):
+        if self.log_level <= 20: self._put_log_record(20, robot_address, stage, index, values)
+
+    def warning(self, robot_address, stage, index=None, *values):
+        if self.log_level <= 30: self._put_log_record(30, robot_address, stage, index, values)
+
+    # Appending the record to the queue according to the overflow policy.
+    def _put_log_record(self, level, robot_address, stage, index, values):
+        if len(self.log_records) >= config["LOG_QUEUE_SIZE"]:
+            if config["LOG_OVERFLOW"] != "block":
+                self.dropped_records += 1
+                return
+            while self.writer_running and len(self.log_records) >= config["LOG_QUEUE_SIZE"]:
+                time.sleep(config["LOG_FLUSH_INTERVAL"] / 10)
+
+        self.log_records.append((time.time(), level, robot_address, stage, index, values))
+
+    # Formatting the record as a line of text, in the same form the console of the server always used.
+    def _format_text(self, log_record):
+        _, _, robot_address, stage, index, values = log_record
+        message = ui[stage] if index is None else ui[stage][index]
+        if robot_address is not None: message = f"Robot ({robot_address[0]}:{robot_address[1]}) {message}"
+
+        return " ".join([message, *map(str, values)]) + "\n"
+
+    # Formatting the record as a JSON object on one line.
+    def _format_json(self, log_record):
+        log_time, level, robot_address, stage, index, values = log_record
+        return json.dumps({
+            "time": log_time, "level": next(name for name, value in log_levels.items() if value == level),
+            "robot": None if robot_address is None else f"{robot_address[0]}:{robot_address[1]}",
+            "stage": stage, "event": index, "message": (ui[stage] if index is None else ui[stage][index]).strip(),
+            "values": [str(value) for value in values]
+        }) + "\n"
+
+    # Loop of the background writer: draining the queue in batches until the writer is stopped and the queue
+    # is empty, reporting the records dropped in the meantime.
+    def _write_log_records(self):
+        format_log_record = self._format_json if config["LOG_FORMAT"] == "json" else self._format_text
+        reported_dropped_records = 0
+
+        while self.writer_running or self.log_records:
+            if self.dropped_records != reported_dropped_records:
+                self.log_records.append((time.time(), 30, None, "log", None,
+                                         (f"(COUNT: {self.dropped_records - reported_dropped_records})",)))
+                reported_dropped_records = self.dropped_records
+
+            log_batch = []
+            while self.log_records and len(log_batch) < config["LOG_BATCH_SIZE"]:
+                log_batch.append(format_log_record(self.log_records.popleft()))
+
+            if log_batch:
+                sys.stdout.write("".join(log_batch))
+                sys.stdout.flush()
+            else: time.sleep(config["LOG_FLUSH_INTERVAL"])
+
+
+# The logger of this process.
+logger = RobotLogger()
+
+
+# Store of the authentication keys, taken from config["AUTH_KEYS"] or from the JSON file config["AUTH_KEYS_FILE"]
+# mapping any number of key ids to the [server key, client key] pairs. The file is checked for changes at most
+# once per AUTH_KEYS_RELOAD_INTERVAL seconds and reloaded without restarting the server; a file that fails to load
+# keeps the previous keys. Both keys are stored as offsets already reduced modulo MOD (the client key negated),
+# so each hash costs a single addition, and the base hashes of recent usernames are kept in an LRU cache,
+# so robots reconnecting after a restart of the fleet skip hashing their usernames again.
+class AuthKeyStore:
+    def __init__(self):
+        self.keys = None
+        self.keys_file_mtime = self.next_reload_check = 0
+        self.reload_lock = Lock()
+        self.get_base_hash = self._compute_base_hash
+
+    # Loading the keys and creating the cache of the base hashes, done once by the server before serving robots.
+    def load(self):
+        self.get_base_hash = lru_cache(config["AUTH_HASH_CACHE"])(self._compute_base_hash) \
+            if config["AUTH_HASH_CACHE"] else self._compute_base_hash
+
+        if config["AUTH_KEYS_FILE"]:
+            self.keys_file_mtime = os.stat(config["AUTH_KEYS_FILE"]).st_mtime_ns
+            with open(config["AUTH_KEYS_FILE"]) as keys_file: self.keys = self._precompute_keys(json.load(keys_file))
+            self.next_reload_check = time.monotonic() + config["AUTH_KEYS_RELOAD_INTERVAL"]
+        else: self.keys = self._precompute_keys(config["AUTH_KEYS"])
+
+        logger.info(None, "keys", 0, f"(COUNT: {len(self.keys)})")
+
+    # Converting the key pairs to the offsets added to the base hash of the username (server key)
+    # and to the hash sent by the robot (client key).
+    def _precompute_keys(self, auth_keys):
+        precomputed_keys = {}
+        for keyid, (server_key, robot_key) in auth_keys.items():
+            if int(keyid) < 0 or type(server_key) is not int or type(robot_key) is not int: raise ValueError(keyid)
+            precomputed_keys[int(keyid)] = (server_key % config["MOD"], -robot_key % config["MOD"])
+
+        return precomputed_keys
+
+    # Reloading the keys file if it was modified since it was loaded. Only one thread checks the file at a time,
+    # the others keep using the current keys meanwhile.
+    def _reload_keys(self):
+        if not self.reload_lock.acquire(blocking=False): return
 
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['auth'][5]} {robot_hash}.")
+        try:
+            self.next_reload_check = time.monotonic() + config["AUTH_KEYS_RELOAD_INTERVAL"]
+            keys_file_mtime = os.stat(config["AUTH_KEYS_FILE"]).st_mtime_ns
+            if keys_file_mtime == self.keys_file_mtime: return
+
+            with open(config["AUTH_KEYS_FILE"]) as keys_file: self.keys = self._precompute_keys(json.load(keys_file))
+            self.keys_file_mtime = keys_file_mtime
+            logger.info(None, "keys", 0, f"(COUNT: {len(self.keys)})")
+        except (OSError, ValueError, TypeError, AttributeError) as error:
+            logger.warning(None, "keys", 1, f"({type(error).__name__}: {error})")
+        finally: self.reload_lock.release()
+
+    # Returning the precomputed (server, client) offsets of the key, or None for an unknown key id.
+    def get_key(self, keyid):
+        if self.keys is None: self.load()
+        elif self.next_reload_check and time.monotonic() >= self.next_reload_check: self._reload_keys()
+
+        return self.keys.get(keyid)
+
+    # Base hash of the username: the sum of its character codes (computed by the C-level map instead
+    # of building a list of them) multiplied by 1000, modulo MOD.
+    @staticmethod
+    def _compute_base_hash(username): return sum(map(ord, username)) * 1000 % config["MOD"]
+
+
+# The authentication keys of this process.
+auth_keys = AuthKeyStore()
+
+
+# Cache of the obstacles discovered by all client-robots, as all of them navigate the same map towards the gift.
+# It is a fixed-size open-addressing hash table of 64-bit slots (0 marks an empty slot) placed in an anonymous
+# shared memory map, so it is created once by the server and inherited by all worker processes. Every cell packs
+# into a single slot, which is read and written with one machine word access, so the table needs no lock:
+# concurrent writers may at worst lose an entry, which the cache tolerates. A cell is looked up in a small
+# number of consecutive slots starting at its hash position (the table has that many extra slots at its end,
+# so no wrapping is needed); when all of them are taken, one of them is evicted.
+# The hit and miss counters are local to the process (logged when it ends) and updated once per planned route,
+# together with the robot_obstacles_cache_lookups_total metric, which the stats interface sums over all workers.
+class ObstaclesCache:
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self.cache_probes = config["OBSTACLES_CACHE_PROBES"]
+        self.cache_memory = mmap.mmap(-1, (cache_size + self.cache_probes) * 8)
+        self.cache_slots = memoryview(self.cache_memory).cast("Q")
+        self.hits = self.misses = 0
+        self.counters_lock = Lock()
+
+    # Packing the coordinates of the cell into the value of a slot, the highest bit marking an occupied slot.
+    def _pack_cell(self, cell): return 1 << 63 | (cell[0] & 0x7FFFFFFF) << 31 | cell[1] & 0x7FFFFFFF
+
+    # Index of the first slot in which the cell may be stored.
+    def _get_cell_slot(self, cell): return hash(cell) % self.cache_size
+
+    def contains(self, cell):
+        cell_slot = self._get_cell_slot(cell)
+        return self._pack_cell(cell) in self.cache_slots[cell_slot:cell_slot + self.cache_probes]
+
+    def add(self, cell):
+        packed_cell, cell_slot = self._pack_cell(cell), self._get_cell_slot(cell)
+        for probe_slot in range(cell_slot, cell_slot + self.cache_probes):
+            if self.cache_slots[probe_slot] in (0, packed_cell):
+                self.cache_slots[probe_slot] = packed_cell
+                return
+
+        self.cache_slots[cell_slot + packed_cell % self.cache_probes] = packed_cell
+
+    def discard(self, cell):
+        packed_cell, cell_slot = self._pack_cell(cell), self._get_cell_slot(cell)
+        for probe_slot in range(cell_slot, cell_slot + self.cache_probes):
+            if self.cache_slots[probe_slot] == packed_cell: self.cache_slots[probe_slot] = 0
+
+    # Adding the lookups of one planned route to the counters.
+    def count_lookups(self, hits, misses):
+        with self.counters_lock:
+            self.hits += hits
+            self.misses += misses
+        server_metrics.increment("robot_obstacles_cache_lookups_total", "hit", hits)
+        server_metrics.increment("robot_obstacles_cache_lookups_total", "miss", misses)
+
+
+# Recorder of the sessions of the client-robots, writing the timestamped events of every session (see record_events)
+# to an append-only binary log in RECORD_DIR, from which the sessions can be replayed (see replay.py). The log is
+# a series of files of RECORD_FILE_SIZE bytes, each memory-mapped, so a record is a copy into memory without any
+# system call. Every record is a header (session id, time, event, length of the data) followed by the data,
+# and a zero session id marks the end of a file. When a record does not fit, the file is truncated to its records
+# and the next one is started. Every process serving robots writes its own files, named by its random token, which
+# is also the upper half of the ids of its sessions. The records of all threads are written under one lock.
+class SessionRecorder:
+    record_header = struct.Struct("<QdBI")
 
-        if (int(robot_hash) - config["AUTH_KEYS"][self.robot_keyid][1]) % config["MOD"] != self.robot_base_hash:
-            raise LoginException()
+    def __init__(self):
+        self.record_lock = Lock()
+        self.record_file = self.record_memory = None
+        self.record_token = self.record_number = self.record_offset = self.record_sessions = 0
+
+    # Starting the log of this process, with a token of its own.
+    def open(self):
+        self.record_token = int.from_bytes(os.urandom(4), "little") | 1
+        self.record_number = self.record_sessions = 0
+        self._open_file()
+
+    def _open_file(self):
+        self.record_number += 1
+        record_name = f"sessions-{self.record_token:08x}-{self.record_number:06d}.rec"
+        self.record_file = open(os.path.join(config["RECORD_DIR"], record_name), "w+b")
+        self.record_file.truncate(config["RECORD_FILE_SIZE"])
+        self.record_memory = mmap.mmap(self.record_file.fileno(), config["RECORD_FILE_SIZE"])
+        self.record_offset = 0
+
+    # Closing the current file, truncated to the records written into it.
+    def _close_file(self):
+        self.record_memory.close()
+        self.record_file.truncate(self.record_offset)
+        self.record_file.close()
+        self.record_file = self.record_memory = None
+
+    def close(self):
+        with self.record_lock:
+            if self.record_file is not None: self._close_file()
+
+        logger.info(None, "record", None, f"(SESSIONS: {self.record_sessions}, FILES: {self.record_number})")
+
+    # Appending the record of the event, its data given in any number of parts. Records that cannot fit even
+    # into an empty file are not written.
+    def record(self, session_id, event, *record_parts):
+        record_length = sum(map(len, record_parts))
+        record_end = self.record_header.size + record_length
+        if record_end > config["RECORD_FILE_SIZE"]: return
+
+        with self.record_lock:
+            if self.record_file is None: return
+            if self.record_offset + record_end > config["RECORD_FILE_SIZE"]:
+                self._close_file()
+                self._open_file()
+
+            record_offset = self.record_offset
+            self.record_header.pack_into(self.record_memory, record_offset,
+                                         session_id, time.time(), event, record_length)
+            record_offset += self.record_header.size
+            for record_part in record_parts:
+                self.record_memory[record_offset:record_offset + len(record_part)] = record_part
+                record_offset += len(record_part)
+            self.record_offset = record_offset
+
+    # Recording the start of a new session and returning its id.
+    def start_session(self, robot_address):
+        with self.record_lock:
+            self.record_sessions += 1
+            session_id = self.record_token << 32 | self.record_sessions
+
+        self.record(session_id, record_events["OPENED"], f"{robot_address[0]}:{robot_address[1]}".encode())
+        return session_id
+
+
+# Storage of the metrics of the server. All values are doubles in an anonymous shared memory map, divided into one
+# slot per worker process: every process writes only into its own slot (a worker restarted with the same number
+# continues its slot), so the supervisor can sum all slots into the exported values at any time. A histogram takes
+# its bucket counts (the last for +Inf), sum and count, a counter one value per label. Within a process, each
+# metric is updated under its own lock, held only for the few additions. The buckets (or labels), offset and lock
+# of every metric are resolved once, so an update costs a single dictionary lookup.
+class ServerMetrics:
+    def __init__(self):
+        self.metric_offsets, self.metrics_size = {}, 0
+        for name, (kind, _, values) in metrics.items():
+            self.metric_offsets[name] = self.metrics_size
+            self.metrics_size += len(values) + 3 if kind == "histogram" else len(values)
+
+        self.metric_entries = {name: (values, self.metric_offsets[name], Lock())
+                               for name, (_, _, values) in metrics.items()}
+        self.allocate(1)
+
+    # Allocating the shared memory for the given number of worker processes, starting with the first slot.
+    def allocate(self, slots):
+        self.metrics_slots = slots
+        self.metrics_memory = mmap.mmap(-1, slots * self.metrics_size * 8)
+        self.metrics_values = memoryview(self.metrics_memory).cast("d")
+        self.metrics_slot = 0
+
+    # Choosing the slot of this process.
+    def use_slot(self, slot): self.metrics_slot = slot * self.metrics_size
+
+    def observe(self, name, value):
+        buckets, metric_offset, metric_lock = self.metric_entries[name]
+        metric_offset += self.metrics_slot
+        metrics_values = self.metrics_values
+        with metric_lock:
+            metrics_values[metric_offset + bisect_left(buckets, value)] += 1
+            metric_offset += len(buckets)
+            metrics_values[metric_offset + 1] += value
+            metrics_values[metric_offset + 2] += 1
+
+    def increment(self, name, label, value=1):
+        labels, metric_offset, metric_lock = self.metric_entries[name]
+        metric_offset += self.metrics_slot + labels.index(label)
+        with metric_lock: self.metrics_values[metric_offset] += value
+
+    def set(self, name, label, value):
+        labels, metric_offset, _ = self.metric_entries[name]
+        self.metrics_values[metric_offset + self.metrics_slot + labels.index(label)] = value
+
+    # Exporting the values summed over all slots in the Prometheus text format.
+    def export(self):
+        values = [sum(self.metrics_values[slot * self.metrics_size + index] for slot in range(self.metrics_slots))
+                  for index in range(self.metrics_size)]
+
+        lines = []
+        for name, (kind, description, labels) in metrics.items():
+            metric_offset = self.metric_offsets[name]
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+
+            if kind != "histogram":
+                label_name = "state" if kind == "gauge" else "result"
+                lines += [f'{name}{{{label_name}="{label}"}} {values[metric_offset + index]:.0f}'
+                          for index, label in enumerate(labels)]
+                continue
+
+            bucket_count = 0
+            for index, bucket in enumerate([*labels, "+Inf"]):
+                bucket_count += values[metric_offset + index]
+                lines.append(f'{name}_bucket{{le="{bucket}"}} {bucket_count:.0f}')
+            lines += [f"{name}_sum {values[metric_offset + len(labels) + 1]:.6f}",
+                      f"{name}_count {values[metric_offset + len(labels) + 2]:.0f}"]
+
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of this process (and, through the shared memory, of all worker processes).
+server_metrics = ServerMetrics()
+
+
+# Handler of the requests of the stats interface, answering GET /config with the configuration of the server
+# (see dump_config) and any other GET request with the current metrics. It is combined with the request handler
+# of http.server when the stats interface is launched, as the module is imported only then.
+class StatsRequestHandler:
+    def do_GET(self):
+        if self.path == "/config": response, content_type = dump_config().encode(), "application/json"
+        else: response, content_type = server_metrics.export().encode(), "text/plain; version=0.0.4"
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args): pass
+
+
+# Timeout manager of the sessions of this process. Instead of the timeout of the socket being set before every receive,
+# a session waiting for data from its client-robot is put on a hashed timer wheel of TIMER_SLOTS slots, each covering
+# TIMER_RESOLUTION seconds, into the slot of its deadline (a session whose deadline lies more than one turn
+# of the wheel ahead stays in its slot for further turns), so scheduling and cancelling a timer is adding it to a set
+# and removing it. The wheel is advanced by a reaper (a thread with the thread engine, a periodic callback of the event
+# loop with the asyncio engine), which expires the sessions of all passed slots at once: the session is marked with
+# the exception ending it and the reading side of its socket is shut down, waking the session blocked in receiving.
+# While the server drains, every session still waiting at the drain deadline is expired and logged out.
+# The number of sessions waiting in every state is exported by the reaper as the robot_sessions_waiting gauge.
+class SessionTimers:
+    def __init__(self):
+        self.timer_wheel = []
+        self.timer_lock = Lock()
+        self.timer_resolution = self.timer_tick = self.drain_deadline = None
+        self.waiting_sessions = dict.fromkeys(session_states, 0)
+        self.reaper_running = False
+        self.reaper_thread = self.reaper_handle = None
+
+    # Starting the reaper of this process: a thread, or a periodic callback of the given event loop.
+    def start(self, event_loop=None):
+        self.timer_resolution = config["TIMER_RESOLUTION"]
+        self.timer_wheel = [set() for _ in range(config["TIMER_SLOTS"])]
+        self.timer_tick = int(time.monotonic() / self.timer_resolution)
+        self.reaper_running = True
+        if event_loop is None: self.reaper_thread = start_thread(self._run_reaper, daemon=True)
+        else: self.reaper_handle = event_loop.call_later(self.timer_resolution, self._advance_async, event_loop)
+
+    # Stopping the reaper (after the sessions ended).
+    def stop(self):
+        self.reaper_running = False
+        if self.reaper_thread is not None: self.reaper_thread.join()
+        if self.reaper_handle is not None: self.reaper_handle.cancel()
+        self.reaper_thread = self.reaper_handle = None
+
+    def _run_reaper(self):
+        while self.reaper_running:
+            time.sleep(self.timer_resolution)
+            self.advance()
+
+    def _advance_async(self, event_loop):
+        self.advance()
+        self.reaper_handle = event_loop.call_later(self.timer_resolution, self._advance_async, event_loop)
+
+    # Setting the deadline after which the sessions of the draining server are logged out.
+    def drain(self, timeout): self.drain_deadline = time.monotonic() + timeout
+
+    # Scheduling the timer of a session about to wait at most the given time for data from its client-robot.
+    # The session expires at the first tick of the wheel after its deadline; past the drain deadline,
+    # it ends at once.
+    def schedule(self, session, timeout):
+        now = time.monotonic()
+        if self.drain_deadline is not None and now >= self.drain_deadline: raise ShutdownException()
+
+        deadline_tick = -int(-(now + timeout) // self.timer_resolution)
+        with self.timer_lock:
+            session.timer_tick = deadline_tick
+            self.timer_wheel[deadline_tick % len(self.timer_wheel)].add(session)
+            self.waiting_sessions[session.session_state] += 1
+
+    # Cancelling the timer of a session which received data (or expired meanwhile).
+    def cancel(self, session):
+        with self.timer_lock:
+            if session.timer_tick is not None: self._remove_session(session)
+
+    def _remove_session(self, session):
+        self.timer_wheel[session.timer_tick % len(self.timer_wheel)].discard(session)
+        self.waiting_sessions[session.session_state] -= 1
+        session.timer_tick = None
+
+    # Advancing the wheel to the current tick, expiring the sessions of all passed slots whose deadline came
+    # (with TimeoutException), or all sessions once the drain deadline passed (with ShutdownException).
+    def advance(self):
+        now = time.monotonic()
+        current_tick = int(now / self.timer_resolution)
+        server_drained = self.drain_deadline is not None and now >= self.drain_deadline
+
+        with self.timer_lock:
+            timer_wheel, wheel_size = self.timer_wheel, len(self.timer_wheel)
+            passed_ticks = range(self.timer_tick + 1, min(current_tick, self.timer_tick + wheel_size) + 1)
+            passed_slots = timer_wheel if server_drained else [timer_wheel[tick % wheel_size] for tick in passed_ticks]
+            self.timer_tick = current_tick
+
+            for timer_slot in passed_slots:
+                expired_sessions = [session for session in timer_slot
+                                    if server_drained or session.timer_tick <= current_tick]
+                for session in expired_sessions:
+                    self._expire_session(session, ShutdownException if server_drained else TimeoutException)
+
+            for state, waiting_sessions in self.waiting_sessions.items():
+                server_metrics.set("robot_sessions_waiting", state, waiting_sessions)
+
+    # Expiring a session: it is marked with the exception ending it, which its driver raises once woken up.
+    def _expire_session(self, session, expired_exception):
+        self._remove_session(session)
+        session.session_expired = expired_exception
+        try: session.robot_socket.shutdown(socket.SHUT_RD)
+        except OSError: pass
+
+
+# The timeout manager of this process.
+session_timers = SessionTimers()
 
-    # Successful authentication completion.
-    def _end_authentication(self):
-        self.send_packet(packets["server"]["SERVER_OK"])
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['auth'][6]}")
 
-    # Function returning unprocessed packets from the packets' queue.
-    def get_robot_packets_queue(self): return self.robot_packets_queue
+# Class engine that implements the main functionality of any server - receiving data from the client
+# and sending data back to the client. For the convenience of working with sockets, address,
+# and client packets stream, 3 corresponding class variables are created. The engine itself never blocks
+# on the socket: every function that needs more data from the client is a generator that yields
+# the pair (maximum length, timeout) and is resumed with the received bytes. This way the same session
+# is driven either by a blocking thread or by an asyncio event loop (see ConnectionMechanism).
+# The time of the last sent packet is kept to measure the round trip of the reply, and the recharges of the robot
+# are counted, so the session can tell the robot recharged while it waited. With the session recorder enabled,
+# all received and sent data is recorded under the id of the session. The state of session_states the session
+# waits in is kept for the timers and the log.
+# The drivers enforce the timeouts with the timeout manager (see SessionTimers), which keeps the tick of the deadline
+# of the session while it waits for data and marks an expired session with the exception ending it.
+# As thousands of sessions may be served at once, their attributes are slots, and the values of the configuration
+# used on every packet are resolved into class attributes once the configuration is final.
+class ServerEngine:
+    __slots__ = ("robot_socket", "robot_address", "robot_packets_queue", "packet_sent_at", "robot_recharges",
+                 "robot_session_id", "session_state", "timer_tick", "session_expired")
+    session_recorder = None
+    robot_recharging, robot_full_power = packets["robot"]["CLIENT_RECHARGING"], packets["robot"]["CLIENT_FULL_POWER"]
 
-    # The entire authentication process.
-    def authenticate_robot(self):
-        print(f"\nRobot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['auth'][0]}")
+    def __init__(self, robot_socket, robot_address):
+        self.robot_socket = robot_socket
+        self.robot_address = robot_address
+        self.robot_packets_queue = PacketsQueue()
+        self.packet_sent_at = None
+        self.robot_recharges = 0
+        self.robot_session_id = self.session_state = None
+        self.timer_tick = self.session_expired = None
+
+    # Resolving the values of the configuration used by the engine: the maximum length (at least the length
+    # of CLIENT_RECHARGING, which may arrive in any state) and the timeout of the packet expected in every state,
+    # and the corking of the sending.
+    @classmethod
+    def configure(cls):
+        recharging_length = packets["length"]["CLIENT_RECHARGING"]
+        cls.state_packets = {state: (max(packets["length"][packet], recharging_length), config[timeout])
+                             for state, (packet, timeout, *_) in session_states.items()}
+        cls.robot_cork = config["TCP_CORK"] and hasattr(socket, "TCP_CORK")
 
-        self._process_username()
-        self._process_keyid()
-        self._process_server_hash()
-        self._process_robot_hash()
-        self._end_authentication()
+    # This function implements the receiving of packets sent from the client. The main logic involves
+    # an inner loop that requests data from the driver together with the maximum time delay for receiving a packet.
+    # If the delay exceeds the limit, the connection with the robot client is terminated. Otherwise, the received
+    # packet part is placed in the "packet queue" (not exceeding the maximum length of the packet for that specific
+    # type), until a complete packet (containing PROTOCOL_TAG \a\b) can be retrieved from the queue.
+    def _receive_packet(self, packet_length, timeout):
+        packet = self.robot_packets_queue.get_packet(packet_length)
+        while packet is None:
+            packet_buffer = yield packet_length, timeout
+            if self.session_recorder is not None:
+                self.session_recorder.record(self.robot_session_id, record_events["RECEIVED"], packet_buffer)
+            self.robot_packets_queue.put(packet_buffer)
+            packet = self.robot_packets_queue.get_packet(packet_length)
+
+        if self.packet_sent_at is not None:
+            server_metrics.observe("robot_command_round_trip_seconds", time.perf_counter() - self.packet_sent_at)
+            self.packet_sent_at = None
+
+        return packet
+
+    # Function for convenient processing of the packet expected in the given state for the presence of data
+    # on the client-robot's recharge and the next mandatory received packet with data on the full robot charge
+    # (received in the RECHARGE state), as well as checking for a logical error in 2 possible places - without
+    # receiving a recharge packet and 5 seconds after receiving it. Any number of recharges is handled in a loop,
+    # the packet expected in the given state being received again after every one of them.
+    def process_packet(self, state):
+        self.session_state = state
+        processed_packet = yield from self._receive_packet(*self.state_packets[state])
+
+        while processed_packet == self.robot_recharging:
+            logger.debug(self.robot_address, "recharge")
+            self.robot_recharges += 1
+            self.session_state = "RECHARGE"
+            recharging_started_at = time.perf_counter()
+            processed_packet = yield from self._receive_packet(*self.state_packets["RECHARGE"])
+            server_metrics.observe("robot_recharging_seconds", time.perf_counter() - recharging_started_at)
+            if processed_packet != self.robot_full_power: raise LogicException()
+
+            self.session_state = state
+            processed_packet = yield from self._receive_packet(*self.state_packets[state])
+
+        if processed_packet == self.robot_full_power: raise LogicException()
+        return processed_packet
 
+    # Parsing a number sent by the client-robot (a key id, a hash or a coordinate, optionally negative): only ASCII
+    # digits are accepted, as int() would also take spaces, underscores and the digits of other scripts,
+    # and anything else is a syntax error of the robot.
+    @staticmethod
+    def parse_number(number, signed=False):
+        number_digits = number[1:] if signed and number.startswith('-') else number
+        if not (number_digits.isascii() and number_digits.isdigit()): raise SyntaxException()
+        return int(number)
+
+    # Reply of the server carrying a number (the server hash), encoded once for every number.
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def encode_number(number): return (str(number) + config["PROTOCOL_TAG"]).encode()
+
+    # Function responsible for sending the ready packets to the client-robot. The preencoded packets are sent
+    # as they are, all of them in one vectored write (sendmsg), which is repeated for the rest of the data
+    # as long as the socket accepts only a part of it. With TCP_CORK, the socket is corked while the packets
+    # are written, so they leave in full segments even when written in several parts. A write blocked longer than
+    # the send timeout of the socket (a robot which stopped reading, see ConnectionMechanism) ends the session.
+    def send_packet(self, *robot_packets):
+        robot_cork = self.robot_cork and len(robot_packets) > 1
+        try:
+            if robot_cork: self.robot_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            robot_buffers = list(robot_packets)
+            while robot_buffers:
+                sent_length = self.robot_socket.sendmsg(robot_buffers)
+                while robot_buffers and sent_length >= len(robot_buffers[0]): sent_length -= len(robot_buffers.pop(0))
+                if sent_length: robot_buffers[0] = memoryview(robot_buffers[0])[sent_length:]
+            if robot_cork: self.robot_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+        except BlockingIOError: raise TimeoutException()
+        except OSError: raise ConnectionException()
+        self.packet_sent_at = time.perf_counter()
+
+        if self.session_recorder is not None:
+            self.session_recorder.record(self.robot_session_id, record_events["SENT"], *robot_packets)
+
+
+# Adapter giving an asyncio stream pair the same interface as a robot socket, so that the engine classes
+# can send packets, set the options of the socket and close the connection without knowing which engine serves
+# the client-robot. The transport buffers whatever the socket does not accept at once, so a vectored write always
+# sends all the data. As the timeout manager wakes a session blocked in receiving by shutting down its socket,
+# shutdown() cancels the task of the session waiting for data.
+class AsyncRobotSocket:
+    def __init__(self, robot_reader, robot_writer):
+        self.robot_reader = robot_reader
+        self.robot_writer = robot_writer
+        self.robot_task = asyncio.current_task()
+
+    async def recv(self, packet_length): return await self.robot_reader.read(packet_length)
+
+    def sendmsg(self, robot_buffers):
+        self.robot_writer.writelines(robot_buffers)
+        return sum(map(len, robot_buffers))
+
+    def setsockopt(self, *socket_option): self.robot_writer.get_extra_info("socket").setsockopt(*socket_option)
+
+    def shutdown(self, how): self.robot_task.cancel()
+
+    def close(self): self.robot_writer.close()
+
+
+# Class responsible for all stages of interaction between the client-robot and the server: a single session object
+# per connection, which authenticates the client-robot, guides it to the gift and picks up its secret message.
+# The session is the state machine of session_states: in every state, the packet expected from the client-robot
+# is received (see ServerEngine.process_packet, which also handles the recharging of the robot in any state) and
+# passed to the handler of the state, which replies to the robot and returns whether the state is complete, in which
+# case the session moves on to the next state of the table. Every authentication state is complete with its packet,
+# while the search stays in SEARCH as long as it guides the robot: every position received is the reply
+# to the oldest command sent and not replied yet, and is answered by the next command.
+# For the convenience of the search, the session keeps the current position and orientation of the robot, the map
+# of the session, recording for every cell the robot has learned about whether it is an obstacle (True) or a visited
+# free cell (False), the commands sent and not replied yet and the rest of the planned route. Cells not on the map
+# are looked up in the obstacles cache shared by all sessions (if enabled), keeping the numbers of the lookups
+# that hit and counting those that missed for the route being planned. The way the session ended is kept
+# for the session recorder.
+class ConnectionMechanism(ServerEngine):
+    __slots__ = ("robot_username", "robot_keyid", "robot_key", "robot_base_hash",
+                 "robot_position", "robot_orientation", "robot_map", "robot_commands", "cache_hits", "cache_misses",
+                 "sent_commands", "robot_route", "route_recharges", "initial_position", "robot_collisions",
+                 "connection_started_at", "search_started_at", "session_result")
+    obstacles_cache = None
 
-# Class implementing the mechanism of finding a secret message by the client-robot on the server map.
-# Similar to the authentication mechanism class, inherits its functionality from the server engine class for
-# interacting with the client's socket. For the convenience of the implementation of the mechanism,
-# there are 2 variables for determining the current position and orientation of the robot on the map.
-class SearchMechanism(ServerEngine):
     def __init__(self, robot_socket, robot_address):
         super().__init__(robot_socket, robot_address)
-        self.robot_position = None
+        self.robot_username = self.robot_keyid = self.robot_key = self.robot_base_hash = None
+        self.robot_position = self.initial_position = None
         self.robot_orientation = -1
+        self.robot_map = {}
+        self.robot_commands = self.robot_collisions = self.route_recharges = 0
+        self.cache_hits, self.cache_misses = None, 0
+        self.sent_commands = self.robot_route = None
+        self.connection_started_at = time.perf_counter()
+        self.search_started_at = None
+        self.session_result = "success"
+        self._set_socket_options()
+        self._start_session_record()
+
+    # Resolving the values of the configuration used by the sessions: those of the engine, the handler and the next
+    # state of every state, the position of the gift and the tuning of the search and of the sending.
+    @classmethod
+    def configure(cls):
+        super().configure()
+        cls.initial_state = next(iter(session_states))
+        cls.state_transitions = {state: (handler and getattr(cls, handler), next_state)
+                                 for state, (_, _, handler, next_state) in session_states.items()}
+        cls.robot_gift = tuple(config["GIFT"])
+        cls.position_tag = config["POSITION_TAG"]
+        cls.robot_pipeline = config["PIPELINE"]
+        cls.robot_nodelay = int(config["TCP_NODELAY"])
+        send_timeout = config["TIMEOUT_RECHARGING"]
+        cls.robot_send_timeout = struct.pack("ll", int(send_timeout), int(send_timeout % 1 * 1000000))
+
+
+    # Enabling (or disabling) TCP_NODELAY on the connection, so the small packets of the server are sent at once
+    # instead of being delayed by the Nagle algorithm until the previous ones are acknowledged. The send timeout
+    # bounds the writes of the thread engine, which the timer wheel does not cover: a robot that stops reading
+    # cannot block a thread of the pool (nor the drain) for longer than TIMEOUT_RECHARGING, the longest
+    # it may stay silent. The transports of the asyncio engine buffer the writes instead of blocking.
+    def _set_socket_options(self):
+        for socket_option in ((socket.IPPROTO_TCP, socket.TCP_NODELAY, self.robot_nodelay),
+                              (socket.SOL_SOCKET, socket.SO_SNDTIMEO, self.robot_send_timeout)):
+            try: self.robot_socket.setsockopt(*socket_option)
+            except OSError: pass
+
+    # Starting the record of the session, if the session recorder is enabled.
+    def _start_session_record(self):
+        if self.session_recorder is None: return
+        self.robot_session_id = self.session_recorder.start_session(self.robot_address)
+
+    # Here, all interactions are taking place: the session is a generator requesting data from the client-robot,
+    # which is fed by one of the engine drivers below. It runs the state machine from the first state
+    # of session_states until the handler of the last one completes it. The durations of the authentication
+    # and of the search are measured.
+    def _process_robot_session(self):
+        logger.debug(self.robot_address, "auth", 0)
+
+        state = self.initial_state
+        while state is not None:
+            robot_packet = yield from self.process_packet(state)
+            packet_handler, next_state = self.state_transitions[state]
+            if packet_handler(self, robot_packet): state = next_state
+
+        server_metrics.observe("robot_search_seconds", time.perf_counter() - self.search_started_at)
+        server_metrics.observe("robot_session_commands", self.robot_commands)
+        server_metrics.increment("robot_sessions_total", "success")
+
+    # Handler of AUTH_USERNAME: the username is processed into its hash code and the ID of the key is requested.
+    def _process_username(self, username):
+        self.robot_username = username
+        self.robot_base_hash = auth_keys.get_base_hash(username)
+        logger.debug(self.robot_address, "auth", 1, username)
 
-    # Checking the validity of the robot's position coordinate.
-    def _process_robot_coordinate(self, coordinate):
-        return coordinate[1:].isdigit() if coordinate[0] == '-' else coordinate.isdigit()
-
-    # Receiving and validating the current position of the client-robot.
-    def _receive_robot_position(self):
-        position_packet = self.process_packet(packets["length"]["CLIENT_OK"], config["TIMEOUT"]).split(' ')
-        if len(position_packet) != 3 or position_packet[0] != config["POSITION_TAG"] \
-            or not self._process_robot_coordinate(position_packet[1]) \
-            or not self._process_robot_coordinate(position_packet[2]):
+        self.send_packet(packets["server"]["SERVER_KEY_REQUEST"])
+        logger.debug(self.robot_address, "auth", 2)
+        return True
+
+    # Handler of AUTH_KEY_ID: the key is looked up and the server hash code is sent for the client confirmation.
+    def _process_keyid(self, keyid):
+        self.robot_keyid = self.parse_number(keyid)
+        self.robot_key = auth_keys.get_key(self.robot_keyid)
+        if self.robot_key is None: raise AuthKeysException()
+        logger.debug(self.robot_address, "auth", 3, self.robot_keyid)
+
+        server_hash = (self.robot_base_hash + self.robot_key[0]) % config["MOD"]
+        self.send_packet(self.encode_number(server_hash))
+        logger.debug(self.robot_address, "auth", 4, server_hash)
+        return True
+
+    # Handler of AUTH_CONFIRMATION: the client hash code is verified, which completes the authentication,
+    # and the search starts.
+    def _process_robot_hash(self, robot_hash):
+        if len(robot_hash) > packets["length"]["CLIENT_CONFIRMATION"] - len(config["PROTOCOL_TAG"]):
             raise SyntaxException()
+        robot_hash = self.parse_number(robot_hash)
 
-        return [int(position_packet[1]), int(position_packet[2])]
-
-    # Turning the client-robot to the right and changing its orientation depending on the actual orientation.
-    def _move_robot_right(self):
-        self.send_packet(packets["server"]["SERVER_TURN_RIGHT"])
-        self.robot_position = self._receive_robot_position()
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['search'][1]}")
-
-        if self.robot_orientation != -1: self.robot_orientation = (self.robot_orientation + 1) % len(orientation)
-
-    # Turning the client-robot to the left and changing its orientation depending on the actual orientation.
-    def _move_robot_left(self):
-        self.send_packet(packets["server"]["SERVER_TURN_LEFT"])
-        self.robot_position = self._receive_robot_position()
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['search'][2]}")
-
-        if self.robot_orientation != -1: self.robot_orientation = (self.robot_orientation - 1) % len(orientation)
+        logger.debug(self.robot_address, "auth", 5, robot_hash)
 
-    # Moving the robot forward relative to the current position and orientation and describing
-    # the case of collision with an obstacle: turning right, stepping forward, turning left, stepping forward.
-    def _move_robot_forward(self):
-        previous_robot_position = self.robot_position
-
-        self.send_packet(packets["server"]["SERVER_MOVE"])
-        new_robot_position = self._receive_robot_position()
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['search'][3]} {new_robot_position}.")
-
-        if self.robot_position == new_robot_position:
-            self._move_robot_right()
-            self.send_packet(packets["server"]["SERVER_MOVE"])
-            new_robot_position = self._receive_robot_position()
-            print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['search'][3]} {new_robot_position}.")
-
-            self._move_robot_left()
-            previous_robot_position = self.robot_position
-            self.send_packet(packets["server"]["SERVER_MOVE"])
-            new_robot_position = self._receive_robot_position()
-            print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['search'][3]} {new_robot_position}.")
+        if (robot_hash + self.robot_key[1]) % config["MOD"] != self.robot_base_hash:
+            raise LoginException()
 
+        self.send_packet(packets["server"]["SERVER_OK"])
+        logger.info(self.robot_address, "auth", 6)
+        self._start_search()
+        return True
+
+    # Start of the search. The main idea: after the robot turns, the server receives the robot's coordinates without
+    # moving forward, thus avoiding unnecessary steps from the defined step limit (and if the robot already stands
+    # on the gift, no step is needed at all). Then the robot takes one step forward and obtains new coordinates,
+    # after which the server knows the orientation of the robot and can direct it towards the final gift.
+    def _start_search(self):
+        self.search_started_at = time.perf_counter()
+        server_metrics.observe("robot_authentication_seconds", self.search_started_at - self.connection_started_at)
+        logger.debug(self.robot_address, "search", 0)
+        self.sent_commands = []
+        self._send_robot_commands(["SERVER_TURN_RIGHT"])
+
+    # Validating the current position of the client-robot.
+    def _parse_robot_position(self, position_packet):
+        position_parts = position_packet.split(' ')
+        if len(position_parts) != 3 or position_parts[0] != self.position_tag: raise SyntaxException()
+
+        return self.parse_number(position_parts[1], True), self.parse_number(position_parts[2], True)
+
+    # Handler of SEARCH: the position is recorded as the reply to the oldest command not replied yet, and the robot
+    # is guided on: while its orientation is unknown, it is determined first (see _orient_robot), then the robot
+    # follows the routes planned over the map of the session (see _follow_robot_route). The state is complete
+    # once the robot stands on the gift.
+    def _process_robot_position(self, position_packet):
+        command = self.sent_commands.pop(0)
+        robot_moved = self._process_robot_reply(command, self._parse_robot_position(position_packet))
+        if self.robot_orientation == -1: return self._orient_robot(command, robot_moved)
+
+        return self._follow_robot_route(robot_moved)
+
+    # Recording the reply of the client-robot to the command: a turn changes the orientation (once it is known), and
+    # a step forward either brings the robot to a new cell, or (if its orientation is already known) shows the cell
+    # in front of it is an obstacle. Returns whether the robot moved (a turn always succeeds).
+    def _process_robot_reply(self, command, new_robot_position):
+        if command == "SERVER_MOVE":
+            logger.debug(self.robot_address, "search", 3, new_robot_position)
+            robot_moved = new_robot_position != self.robot_position
+            if robot_moved: self._record_robot_cell(new_robot_position, False)
+            elif self.robot_orientation != -1:
+                self._record_robot_cell(self._get_next_cell(self.robot_position, self.robot_orientation), True)
+
+            self.robot_position = new_robot_position
+            return robot_moved
+
+        robot_turn = 1 if command == "SERVER_TURN_RIGHT" else -1
         self.robot_position = new_robot_position
+        logger.debug(self.robot_address, "search", 1 if robot_turn == 1 else 2)
+
+        if self.robot_orientation != -1:
+            self.robot_orientation = (self.robot_orientation + robot_turn) % len(orientation)
+        return True
+
+    # Cell of the map adjacent to the given one in the given orientation.
+    def _get_next_cell(self, cell, cell_orientation):
+        step = orientation_steps[cell_orientation]
+        return cell[0] + step[0], cell[1] + step[1]
+
+    # Recording the cell on the map of the session and correcting the obstacles cache accordingly.
+    def _record_robot_cell(self, cell, cell_obstacle):
+        self.robot_map[cell] = cell_obstacle
+        if self.obstacles_cache is None: return
+
+        if cell_obstacle: self.obstacles_cache.add(cell)
+        else: self.obstacles_cache.discard(cell)
+
+    # Checking whether the cell is a known obstacle, either on the map of the session or in the obstacles cache.
+    def _process_robot_obstacle(self, cell, obstacles_cache):
+        cell_obstacle = self.robot_map.get(cell)
+        if cell_obstacle is not None or obstacles_cache is None: return cell_obstacle
+
+        cell_obstacle = obstacles_cache.contains(cell)
+        if cell_obstacle: self.cache_hits.append(len(self.cache_hits) + self.cache_misses)
+        else: self.cache_misses += 1
+        return cell_obstacle
+
+    # Sending the commands to the client-robot in one write, without waiting for their replies, which are expected
+    # in the order of the commands.
+    def _send_robot_commands(self, commands):
+        self.send_packet(*[packets["server"][command] for command in commands])
+        self.sent_commands += commands
+        self.robot_commands += len(commands)
+
+    # Determining the initial orientation of the robot after the initial turn: the robot steps forward (turning right
+    # after each collision) until it moves, and the orientation follows from the 2 coordinates obtained.
+    # The collisions before that are recorded on the map once the orientation is known, and the route to the gift
+    # is planned. Returns whether the search is complete.
+    def _orient_robot(self, command, robot_moved):
+        if self.initial_position is None:
+            if self.robot_position == self.robot_gift: return self._end_search()
+            self.initial_position = self.robot_position
+            self._record_robot_cell(self.initial_position, False)
+        elif command == "SERVER_MOVE" and not robot_moved:
+            self.robot_collisions += 1
+            if self.robot_collisions == len(orientation): raise LogicException()
+            self._send_robot_commands(["SERVER_TURN_RIGHT"])
+            return False
+        elif command == "SERVER_MOVE":
+            difference = (self.robot_position[0] - self.initial_position[0],
+                          self.robot_position[1] - self.initial_position[1])
+            self.robot_orientation = orientation_steps.index(difference) if difference in orientation_steps \
+                else orientation.index("UP")
+
+            for robot_collision in range(1, self.robot_collisions + 1):
+                collision_orientation = (self.robot_orientation - robot_collision) % len(orientation)
+                self._record_robot_cell(self._get_next_cell(self.initial_position, collision_orientation), True)
+            return self._start_robot_route()
+
+        self._send_robot_commands(["SERVER_MOVE"])
+        return False
+
+    # Searching the route with the least number of commands (a turn costs a round trip just like a step)
+    # from the current position and orientation to the gift, using the A* algorithm over the states
+    # (cell, orientation) with the Manhattan distance as the heuristic. Cells not known as obstacles are expected
+    # to be free, and the search is limited to the rectangle around the robot, the gift and the cells on the map,
+    # so it always ends. Returns the list of the commands of the route, or None if there is no route.
+    def _search_robot_route(self, obstacles_cache):
+        gift = self.robot_gift
+        known_cells = [self.robot_position, gift, *self.robot_map]
+        min_x, max_x = min(cell[0] for cell in known_cells) - 1, max(cell[0] for cell in known_cells) + 1
+        min_y, max_y = min(cell[1] for cell in known_cells) - 1, max(cell[1] for cell in known_cells) + 1
+
+        initial_state = (self.robot_position, self.robot_orientation)
+        route_costs, route_previous = {initial_state: 0}, {initial_state: None}
+        initial_distance = abs(gift[0] - self.robot_position[0]) + abs(gift[1] - self.robot_position[1])
+        open_states = [(initial_distance, 0, initial_state)]
+
+        while open_states:
+            _, route_cost, state = heapq.heappop(open_states)
+            cell, cell_orientation = state
+            if cell == gift: break
+            if route_cost > route_costs[state]: continue
+
+            next_states = [("SERVER_TURN_RIGHT", (cell, (cell_orientation + 1) % len(orientation))),
+                           ("SERVER_TURN_LEFT", (cell, (cell_orientation - 1) % len(orientation)))]
+            next_cell = self._get_next_cell(cell, cell_orientation)
+            if min_x <= next_cell[0] <= max_x and min_y <= next_cell[1] <= max_y \
+                    and not self._process_robot_obstacle(next_cell, obstacles_cache):
+                next_states.append(("SERVER_MOVE", (next_cell, cell_orientation)))
+
+            for command, next_state in next_states:
+                if route_cost + 1 >= route_costs.get(next_state, route_cost + 2): continue
+
+                route_costs[next_state], route_previous[next_state] = route_cost + 1, (state, command)
+                distance = abs(gift[0] - next_state[0][0]) + abs(gift[1] - next_state[0][1])
+                heapq.heappush(open_states, (route_cost + 1 + distance, route_cost + 1, next_state))
+        else: return None
+
+        robot_route = []
+        while route_previous[state] is not None:
+            state, command = route_previous[state]
+            robot_route.append(command)
+
+        return robot_route[::-1]
+
+    # Planning the route to the gift, consulting the obstacles cache first. Should the cache (filled by other robots)
+    # block every route, the route is planned over the map of the session only. The lookups that hit are recorded
+    # (as JSON), so a replay plans the same routes whatever the cache holds then (see replay.py).
+    def _plan_robot_route(self):
+        robot_route = None
+        if self.obstacles_cache is not None:
+            self.cache_hits, self.cache_misses = [], 0
+            robot_route = self._search_robot_route(self.obstacles_cache)
+            self.obstacles_cache.count_lookups(len(self.cache_hits), self.cache_misses)
+            if self.session_recorder is not None:
+                self.session_recorder.record(self.robot_session_id, record_events["CACHED"],
+                                             json.dumps(self.cache_hits).encode())
+
+        if robot_route is None: robot_route = self._search_robot_route(None)
+        if robot_route is None: raise LogicException()
+
+        return robot_route
+
+    # Planning the route from the current position and orientation of the robot and sending its first commands:
+    # up to PIPELINE commands go out in one write, ahead of their replies, saving a round trip per command on slow
+    # links. Once the robot stands on the gift, the search is complete instead. Returns whether the search is complete.
+    def _start_robot_route(self):
+        if self.robot_position == self.robot_gift: return self._end_search()
+
+        robot_route = self._plan_robot_route()
+        sent_commands = min(self.robot_pipeline, len(robot_route))
+        self.route_recharges, self.robot_route = self.robot_recharges, robot_route[sent_commands:]
+        self._send_robot_commands(robot_route[:sent_commands])
+        return False
+
+    # Following the planned route: every reply is answered by the next command of the route, until a reply shows
+    # a collision with an obstacle (or, with commands sent ahead of their replies, the robot recharged in the meantime),
+    # after which no further command is sent. The robot still executes the commands already sent, so their replies
+    # are consumed in order and recorded on the map like any other, and once all of them arrived, the route is planned
+    # again from wherever the robot ends up. Returns whether the search is complete.
+    def _follow_robot_route(self, robot_moved):
+        if not robot_moved or self.robot_pipeline > 1 and self.route_recharges != self.robot_recharges:
+            self.robot_route = []
+        elif self.robot_route: self._send_robot_commands([self.robot_route.pop(0)])
+
+        if self.sent_commands: return False
+        return self._start_robot_route()
+
+    # End of the search, with the robot standing on the gift: its secret message is requested.
+    def _end_search(self):
+        self.send_packet(packets["server"]["SERVER_PICK_UP"])
+        return True
 
-        return previous_robot_position
-
-    # Determining the first position of the robot relative to the 2 coordinates obtained after the first step forward.
-    def _process_robot_initial_orientation(self, previous_robot_position):
-        difference = [self.robot_position[0] - previous_robot_position[0],
-                      self.robot_position[1] - previous_robot_position[1]]
+    # Handler of PICKUP: receiving the secret message and disconnection from the server, which ends the session.
+    def _process_gift_message(self, gift_message):
+        logger.info(self.robot_address, "search", 4, gift_message)
 
-        if difference[0] == -1 and difference[1] == 0: return orientation.index("LEFT")
-        elif difference[0] == 1 and difference[1] == 0: return orientation.index("RIGHT")
-        elif difference[0] == 0 and difference[1] == -1: return orientation.index("DOWN")
-        else: return orientation.index("UP")
+        self.send_packet(packets["server"]["SERVER_LOGOUT"])
+        logger.info(self.robot_address, "search", 5)
+        return True
+
+    # Blocking receiving of data for the thread engine. The socket stays in the blocking mode, the waiting time
+    # being limited by the timer of the session, which wakes the receiving up when the session expires.
+    def _receive_robot_data(self, packet_length, timeout):
+        session_timers.schedule(self, timeout)
+        try: robot_data = self.robot_socket.recv(packet_length)
+        except OSError: robot_data = b""
+        finally: session_timers.cancel(self)
+
+        if self.session_expired is not None: raise self.session_expired()
+        if not robot_data: raise ConnectionException()
+        return robot_data
+
+    # In case of any exceptions occurring at any stage, the client is disconnected from the server,
+    # with the reason for the error and the state of the session displayed in the console and the corresponding
+    # packet sent to the client (unless the connection fails meanwhile).
+    def _process_robot_exception(self, exception):
+        logger.warning(self.robot_address, "error", None, exception.message, f"(STATE: {self.session_state})")
+        self.session_result = type(exception).__name__
+        server_metrics.increment("robot_sessions_total", self.session_result)
+        try:
+            if exception.packet: self.send_packet(exception.packet)
+        except RobotException: pass
+
+    # Any other exception is an error of the server itself, not of the client-robot: it is logged with its type
+    # and the state of the session, and only this session ends, closed without any packet sent to the client.
+    def _process_server_error(self, error):
+        logger.warning(self.robot_address, "error", None, errors["SERVER"], f"({type(error).__name__}: {error})",
+                       f"(STATE: {self.session_state})")
+        self.session_result = "ServerError"
+        server_metrics.increment("robot_sessions_total", self.session_result)
+
+    # Closing the connection with the client-robot at the end of the session.
+    def _close_connection(self):
+        self.robot_socket.close()
+        if self.session_recorder is not None:
+            self.session_recorder.record(self.robot_session_id, record_events["CLOSED"], self.session_result.encode())
+        server_metrics.observe("robot_session_seconds", time.perf_counter() - self.connection_started_at)
+        logger.info(None, "connection", 1)
 
-    # Choosing the orientation of the next robot step and changing the initial robot orientation for the next step.
-    def _process_robot_next_move(self):
-        difference = [config["GIFT"][0] - self.robot_position[0], config["GIFT"][1] - self.robot_position[1]]
+    # Thread engine driver: the session is served synchronously on the calling thread.
+    def create_connection(self):
+        logger.info(None, "connection", 0)
 
-        next_move_orientation = None
-        if abs(difference[0]) > abs(difference[1]):
-            if difference[0] > 0: next_move_orientation = orientation.index("RIGHT")
-            elif difference[0] < 0: next_move_orientation = orientation.index("LEFT")
-        else:
-            if difference[1] > 0: next_move_orientation = orientation.index("UP")
-            elif difference[1] < 0: next_move_orientation = orientation.index("DOWN")
+        robot_session = self._process_robot_session()
+        try:
+            robot_request = next(robot_session)
+            while True: robot_request = robot_session.send(self._receive_robot_data(*robot_request))
 
-        while self.robot_orientation != next_move_orientation:
-            if self.robot_orientation < next_move_orientation: self._move_robot_right()
-            else: self._move_robot_left()
+        except StopIteration: pass
+        except RobotException as RE: self._process_robot_exception(RE)
+        except Exception as error: self._process_server_error(error)
 
-    # Final stage of the client-robot on the server - receiving a secret message at coordinate [0,0]
-    # and disconnection from the server.
-    def _pick_up_gift_and_logout(self):
-        self.send_packet(packets["server"]["SERVER_PICK_UP"])
-        gift_message = self.process_packet(packets["length"]["CLIENT_MESSAGE"], config["TIMEOUT"])
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['search'][4]} {gift_message}")
+        self._close_connection()
 
-        self.send_packet(packets["server"]["SERVER_LOGOUT"])
-        print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['search'][5]}\n")
+    # Asyncio engine driver: the same session is served as a task of the event loop, the robot socket
+    # being an AsyncRobotSocket, whose task is cancelled when the session expires.
+    async def create_async_connection(self):
+        logger.info(None, "connection", 0)
 
-    # Setting the packet queue from the client after completing the authentication stage.
-    def set_robot_packets_queue(self, robot_packets_queue): self.robot_packets_queue = robot_packets_queue
+        robot_session = self._process_robot_session()
+        try:
+            packet_length, timeout = next(robot_session)
+            while True:
+                session_timers.schedule(self, timeout)
+                try: robot_data = await self.robot_socket.recv(packet_length)
+                except asyncio.CancelledError:
+                    if self.session_expired is None: raise
+                finally: session_timers.cancel(self)
 
-    # Function responsible for the entire process of finding the robot on the map. The main idea:
-    # after the robot turns, the server receives the robot's coordinates without moving forward,
-    # thus avoiding unnecessary steps from the defined step limit. Then the robot takes one step forward and
-    # obtains new coordinates, after which the server knows the orientation of the robot and can direct it
-    # towards the final gift. The internal loop describes all the necessary choices of direction and
-    # movement of the robot. At the end, the final stage is performed.
-    def launch_robot(self):
-        print(f"\nRobot ({self.robot_address[0]}:{self.robot_address[1]}) {ui['search'][0]}")
+                if self.session_expired is not None: raise self.session_expired()
+                if not robot_data: raise ConnectionException()
+                packet_length, timeout = robot_session.send(robot_data)
 
-        self._move_robot_right()
-        previous_robot_position = self._move_robot_forward()
-        self.robot_orientation = self._process_robot_initial_orientation(previous_robot_position)
+        except StopIteration: pass
+        except RobotException as RE: self._process_robot_exception(RE)
+        except Exception as error: self._process_server_error(error)
 
-        while self.robot_position != config["GIFT"]:
-            self._process_robot_next_move()
-            self._move_robot_forward()
+        self._close_connection()
 
-        self._pick_up_gift_and_logout()
+    # Replay driver: the session is fed the parts of the stream recorded by the session recorder (see replay.py),
+    # from an iterable that may raise the exception which ended the recorded session. A session still requesting
+    # data after the last part ends as if the client-robot closed the connection.
+    def replay_connection(self, robot_data):
+        logger.info(None, "connection", 0)
 
+        robot_session = self._process_robot_session()
+        try:
+            next(robot_session)
+            for robot_data_part in robot_data: robot_session.send(robot_data_part)
+            raise ConnectionException()
 
-# Class responsible for all stages of interaction between the client-robot and the server.
-class ConnectionMechanism:
-    def __init__(self, robot_socket, robot_address):
-        self.robot_socket = robot_socket
-        self.robot_address = robot_address
-        self.authentication_mechanism = AuthenticationMechanism(robot_socket, robot_address)
-        self.search_mechanism = SearchMechanism(robot_socket, robot_address)
+        except StopIteration: pass
+        except RobotException as RE: self._process_robot_exception(RE)
+        except Exception as error: self._process_server_error(error)
 
-    # Here, all interactions are taking place: authentication mechanism launch, preparation for the gift search stage,
-    # and the gift search stage itself. In case of any exceptions occurring at any stage,
-    # they are caught in the try-catch block, and the client is disconnected from the server,
-    # with the reason for the error displayed in the console.
-    def create_connection(self):
-        print(f"\n{ui['connection'][0]}")
+        self._close_connection()
 
-        try:
-            self.authentication_mechanism.authenticate_robot()
-            self.search_mechanism.set_robot_packets_queue(self.authentication_mechanism.get_robot_packets_queue())
-            self.search_mechanism.launch_robot()
-
-        except TimeoutException as TE:
-            print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) - {TE.message}\n")
-        except AuthKeysException as AUE:
-            print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) - {AUE.message}\n")
-            self.authentication_mechanism.send_packet(packets["server"]["SERVER_KEY_OUT_OF_RANGE_ERROR"])
-        except LoginException as LE:
-            print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) - {LE.message}\n")
-            self.authentication_mechanism.send_packet(packets["server"]["SERVER_LOGIN_FAILED"])
-        except LogicException as LE:
-            print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) - {LE.message}\n")
-            self.search_mechanism.send_packet(packets["server"]["SERVER_LOGIC_ERROR"])
-        except SyntaxException as SE:
-            print(f"Robot ({self.robot_address[0]}:{self.robot_address[1]}) - {SE.message}\n")
-            self.search_mechanism.send_packet(packets["server"]["SERVER_SYNTAX_ERROR"])
 
-        self.robot_socket.close()
-        print(f"{ui['connection'][1]}\n")
+# The values of the configuration used by the sessions, resolved from the default configuration
+# (and again by the server, once the configuration is final).
+ConnectionMechanism.configure()
 
 
-# Implementation of the server itself and its configuration.
+# Implementation of the server itself and its configuration. With more than one worker configured,
+# the server becomes a supervisor of worker processes, each serving robots independently with its own interpreter
+# (and so its own GIL). Workers either bind the port themselves with SO_REUSEPORT, letting the kernel balance
+# new connections between them, or share the listening socket inherited from the supervisor.
+# On Ctrl+C or SIGTERM the server drains: it stops accepting connections and lets the sessions being served finish
+# within DRAIN_TIMEOUT. On SIGHUP it restarts without downtime: a new server process started with the same command
+# line takes over the listening sockets (passed to it in ROBOT_SERVER_FD) and reports through the pipe passed to it
+# in ROBOT_SERVER_READY_FD that it serves robots, and only then this one drains.
 class Server:
     def __init__(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((config["IP"], config["PORT"]))
-        self.server_socket.listen()
+        logger.configure()
+        self.workers = {}
+        self.worker_number = self.stats_server = None
+        self.server_draining = self.server_restarting = self.server_accepting = False
+        ready_fds = self._inherit_fds("ROBOT_SERVER_READY_FD")
+        self.ready_fd = ready_fds[0] if ready_fds else None
+        server_fds = self._inherit_fds("ROBOT_SERVER_FD")
+        self.server_sockets = [] if self._reuse_port() else self._create_server_sockets(server_fds)
+        server_metrics.allocate(config["WORKERS"])
+        auth_keys.load()
+        if config["OBSTACLES_CACHE"]: ConnectionMechanism.obstacles_cache = ObstaclesCache(config["OBSTACLES_CACHE"])
+        if config["RECORD_DIR"]: ServerEngine.session_recorder = SessionRecorder()
+        ConnectionMechanism.configure()
+
+        logger.info(None, "server", 0, f"(IP: {config['IP']}, PORT: {config['PORT']}, ENGINE: {config['ENGINE']}, "
+                                       f"WORKERS: {config['WORKERS']})")
+
+    # Checking whether every worker process binds its own listening socket.
+    def _reuse_port(self): return config["WORKERS"] > 1 and config["REUSE_PORT"] and hasattr(socket, "SO_REUSEPORT")
+
+    # File descriptors passed to this server by the server it replaces (a comma-separated list), if any.
+    def _inherit_fds(self, fd_name): return [int(fd) for fd in os.environ.pop(fd_name, "").split(",") if fd]
+
+    # Addresses the server listens on: every address of every host (an IP address or a host name, the empty one
+    # standing for all interfaces) of config["IP"] on every port of config["PORT"], with their address families.
+    def _get_server_addresses(self):
+        hosts = config["IP"] if type(config["IP"]) is list else [config["IP"]]
+        ports = config["PORT"] if type(config["PORT"]) is list else [config["PORT"]]
+
+        server_addresses = {}
+        for host in hosts:
+            for port in ports:
+                for family, _, _, _, address in socket.getaddrinfo(host or None, port, type=socket.SOCK_STREAM,
+                                                                   flags=socket.AI_PASSIVE):
+                    if family in (socket.AF_INET, socket.AF_INET6): server_addresses.setdefault(address, family)
+
+        return [(family, address) for address, family in server_addresses.items()]
+
+    # Creating the listening sockets of the server (or of a single worker in the SO_REUSEPORT mode), one per address,
+    # or taking over the listening sockets of the replaced server bound to the same addresses (the others are closed,
+    # so a restart applies changed addresses too). IPv6 sockets accept IPv6 connections only, so IPv4 and IPv6 sockets
+    # can listen on the same port. The buffer sizes are set on the listening sockets, as the accepted connections
+    # inherit them (set before the handshake, they also determine the TCP window scale offered to the robot).
+    def _create_server_sockets(self, server_fds=()):
+        inherited_sockets = {}
+        for server_fd in server_fds:
+            inherited_socket = socket.socket(fileno=server_fd)
+            inherited_sockets[inherited_socket.family, inherited_socket.getsockname()[:2]] = inherited_socket
+
+        server_sockets = []
+        for family, address in self._get_server_addresses():
+            server_socket = inherited_sockets.pop((family, address[:2]), None)
+            if server_socket is None:
+                server_socket = socket.socket(family, socket.SOCK_STREAM)
+                if family == socket.AF_INET6: server_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+                if self._reuse_port(): server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                server_socket.bind(address)
+
+            for buffer_option, buffer_size in ((socket.SO_RCVBUF, config["RECV_BUFFER"]),
+                                               (socket.SO_SNDBUF, config["SEND_BUFFER"])):
+                if buffer_size: server_socket.setsockopt(socket.SOL_SOCKET, buffer_option, buffer_size)
+            server_socket.listen(config["BACKLOG"])
+            server_sockets.append(server_socket)
+
+        for inherited_socket in inherited_sockets.values(): inherited_socket.close()
+        return server_sockets
+
+    # Closing the connection with a client-robot that cannot be admitted, as the server is overloaded.
+    def _reject_connection(self, robot_socket, robot_address):
+        robot_socket.close()
+        server_metrics.increment("robot_connections_total", "rejected")
+        logger.warning(robot_address, "overload")
+
+    # Loop of a thread of the pool: serving the accepted connections from the accept queue one by one,
+    # until the thread receives None instead of a connection. An unexpected error of a session is logged and
+    # only ends that session: its socket is closed and the thread goes on serving, so the pool never shrinks.
+    def _serve_pool_connections(self):
+        while True:
+            robot_connection = self.accept_queue.get()
+            if robot_connection is None: return
+
+            with self.pool_lock: self.busy_threads += 1
+            try:
+                # The socket may inherit the non-blocking mode of the listening socket (on BSD systems, not on Linux).
+                robot_connection[0].setblocking(True)
+                ConnectionMechanism(*robot_connection).create_connection()
+            except Exception as error:
+                logger.warning(robot_connection[1], "error", None, f"({type(error).__name__}: {error})")
+            finally:
+                robot_connection[0].close()
+                with self.pool_lock: self.busy_threads -= 1
+
+    # Admission of an accepted connection. While a thread of the pool is idle, the connection is handed to it
+    # at once. Otherwise, the connection is handled according to the overload policy: "queue" keeps it in the
+    # bounded accept queue (rejecting it when the queue is full), "reject" closes it right away, and "delay" waits
+    # for a place in the queue (see _delay_connection), so no further connections are accepted meanwhile and new robots
+    # wait in the listen backlog of the kernel.
+    def _admit_connection(self, robot_socket, robot_address):
+        pool_overloaded = self.busy_threads + self.accept_queue.qsize() >= config["MAX_SESSIONS"]
+
+        if pool_overloaded and config["OVERLOAD"] == "reject":
+            return self._reject_connection(robot_socket, robot_address)
+        if pool_overloaded and config["OVERLOAD"] == "delay": self._delay_connection((robot_socket, robot_address))
+        else:
+            try: self.accept_queue.put_nowait((robot_socket, robot_address))
+            except Full: return self._reject_connection(robot_socket, robot_address)
+
+        server_metrics.increment("robot_connections_total", "queued" if pool_overloaded else "served")
+
+    # Waiting for a place in the accept queue for a connection of the "delay" policy. While the server accepts
+    # connections, the signals of the server are delivered every TIMER_RESOLUTION seconds of the waiting, so it can
+    # be interrupted or restarted meanwhile (the connection is then admitted once the server drains, see
+    # _launch_threads). Once the server drains, the sessions end by the drain deadline, so it just waits for its place.
+    def _delay_connection(self, robot_connection):
+        while self.server_accepting:
+            try: return self.accept_queue.put(robot_connection, timeout=config["TIMER_RESOLUTION"])
+            except Full: deliver_signals()
+
+        self.accept_queue.put(robot_connection)
+
+    # Accepting the connections already waiting in the listen backlogs before the listening sockets are closed,
+    # as the kernel would reset them (in the SO_REUSEPORT mode, no other process serves the backlog of this one).
+    def _accept_pending_connections(self):
+        robot_connections = []
+        for server_socket in self.server_sockets:
+            while True:
+                try: robot_connections.append(server_socket.accept())
+                except OSError: break
+
+        return robot_connections
+
+    # Function responsible for connecting new clients with the thread engine. Every robot is served by one thread
+    # of a pool of MAX_SESSIONS threads created in advance, so no thread is created per connection and a burst
+    # of connections cannot create an unbounded number of threads. As the client has no impact on any server
+    # configuration data or variables, the only shared state is the accept queue and the number of busy threads.
+    # When the server is interrupted, it drains: the connections waiting in the listen backlog are accepted before
+    # the listening sockets are closed and admitted (with those accepted but not admitted yet) once the drain deadline
+    # runs, and the threads finish the sessions admitted and end. A connection leaves the list of the accepted ones
+    # only once admitted, so the interrupt of a server waiting to admit it (see _delay_connection) keeps it there.
+    def _launch_threads(self):
+        self.accept_queue = Queue(config["ACCEPT_QUEUE"])
+        self.pool_lock, self.busy_threads = Lock(), 0
+        pool_threads = [start_thread(self._serve_pool_connections) for _ in range(config["MAX_SESSIONS"])]
+        session_timers.start()
+
+        for server_socket in self.server_sockets: server_socket.setblocking(False)
+        self.server_accepting, robot_connections = True, []
+        try:
+            while True:
+                robot_connections = accept_connections(self.server_sockets)
+                while robot_connections:
+                    self._admit_connection(*robot_connections[0])
+                    robot_connections.pop(0)
+        finally:
+            self.server_accepting = False
+            robot_connections += self._accept_pending_connections()
+            self._start_draining()
+            for robot_connection in robot_connections: self._admit_connection(*robot_connection)
+            for _ in pool_threads: self.accept_queue.put(None)
+            for pool_thread in pool_threads: pool_thread.join()
+            session_timers.stop()
+            if hasattr(signal, "pthread_sigmask"): signal.pthread_sigmask(signal.SIG_UNBLOCK, server_signals)
+
+    # Task of the asyncio engine, serving one accepted client-robot. At most MAX_SESSIONS robots are served
+    # at the same time, further robots are handled according to the overload policy as with the thread engine:
+    # "queue" lets at most ACCEPT_QUEUE of them wait for their turn and "reject" closes them right away, while
+    # with "delay" no further robots are accepted meanwhile (see _accept_async_connections).
+    async def _serve_async_connection(self, robot_socket, robot_address):
+        sessions_overloaded = self.sessions_semaphore.locked()
+        if sessions_overloaded and (config["OVERLOAD"] == "reject" or config["OVERLOAD"] == "queue"
+                                    and self.queued_sessions >= config["ACCEPT_QUEUE"]):
+            return self._reject_connection(robot_socket, robot_address)
+
+        server_metrics.increment("robot_connections_total", "queued" if sessions_overloaded else "served")
+        self.queued_sessions += sessions_overloaded
+        try: await self.sessions_semaphore.acquire()
+        finally: self.queued_sessions -= sessions_overloaded
 
-        print(f"\n\n{ui['server'][0]}\n")
+        try:
+            robot_reader, robot_writer = await asyncio.open_connection(sock=robot_socket)
+            new_robot_connection = ConnectionMechanism(AsyncRobotSocket(robot_reader, robot_writer), robot_address)
+            await new_robot_connection.create_async_connection()
+        finally: self.sessions_semaphore.release()
+
+    # Starting the task of the session of an accepted connection. The task is registered at once, so the drain
+    # awaits every session started, and a session ending resumes the accepting paused by the "delay" policy.
+    def _start_async_session(self, robot_socket, robot_address):
+        session_task = asyncio.create_task(self._serve_async_connection(robot_socket, robot_address))
+        self.async_sessions.add(session_task)
+        session_task.add_done_callback(self._end_async_session)
+
+    def _end_async_session(self, session_task):
+        self.async_sessions.discard(session_task)
+        if self.accepting_paused and len(self.async_sessions) < config["MAX_SESSIONS"]:
+            self.accepting_paused = False
+            self._start_async_accepting()
+
+    # Accepting loop of the asyncio engine, run by the event loop whenever a listening socket is readable: the
+    # connections waiting on it are accepted (at most BACKLOG at once, so other sockets and sessions are not
+    # starved). With the "delay" policy, accepting pauses on all the sockets once MAX_SESSIONS robots are served,
+    # so further robots wait in the listen backlog of the kernel instead of piling up as tasks, as with the thread
+    # engine. Nothing is cancelled to stop accepting, so no connection accepted by the kernel is ever dropped.
+    def _accept_async_connections(self, server_socket):
+        for _ in range(config["BACKLOG"]):
+            if config["OVERLOAD"] == "delay" and len(self.async_sessions) >= config["MAX_SESSIONS"]:
+                self.accepting_paused = True
+                return self._stop_async_accepting()
+
+            try: robot_socket, robot_address = server_socket.accept()
+            except OSError: return
+            self._start_async_session(robot_socket, robot_address)
+
+    # Starting (or resuming) and stopping the accepting of the asyncio engine on all the listening sockets.
+    def _start_async_accepting(self):
+        event_loop = asyncio.get_running_loop()
+        for server_socket in self.server_sockets:
+            event_loop.add_reader(server_socket, self._accept_async_connections, server_socket)
+
+    def _stop_async_accepting(self):
+        event_loop = asyncio.get_running_loop()
+        for server_socket in self.server_sockets: event_loop.remove_reader(server_socket)
+
+    # Function responsible for connecting new clients with the asyncio engine. All clients are served
+    # by a single thread, so thousands of concurrent robots do not cost a thread stack each. The signals
+    # interrupting the server are handled by the event loop, which then drains the server: accepting stops,
+    # the connections waiting in the listen backlogs are taken as with the thread engine, the listening sockets
+    # are closed and the tasks of the sessions are awaited until they end (being logged out at the drain deadline).
+    async def _launch_asyncio(self):
+        self.sessions_semaphore, self.queued_sessions = asyncio.Semaphore(config["MAX_SESSIONS"]), 0
+        self.async_sessions, self.accepting_paused = set(), False
+        event_loop, server_interrupted = asyncio.get_running_loop(), asyncio.Event()
+        session_timers.start(event_loop)
+        for interrupt_signal in self._get_interrupt_signals():
+            event_loop.add_signal_handler(interrupt_signal, server_interrupted.set)
+        if self.worker_number is None and hasattr(signal, "SIGHUP"):
+            event_loop.add_signal_handler(signal.SIGHUP, self._restart_server)
+
+        for server_socket in self.server_sockets: server_socket.setblocking(False)
+        self._start_async_accepting()
+        await server_interrupted.wait()
+
+        self.accepting_paused = False
+        self._stop_async_accepting()
+        for robot_connection in self._accept_pending_connections(): self._start_async_session(*robot_connection)
+        self._start_draining()
+        await self._await_async_sessions(event_loop.time() + config["DRAIN_TIMEOUT"] + config["TIMEOUT_RECHARGING"])
+        session_timers.stop()
+
+    # Awaiting the tasks of the sessions until all of them end or the drain deadline passes.
+    async def _await_async_sessions(self, drain_deadline):
+        event_loop = asyncio.get_running_loop()
+        while self.async_sessions and event_loop.time() < drain_deadline:
+            await asyncio.wait(set(self.async_sessions), timeout=drain_deadline - event_loop.time())
+
+    # Launching the engine chosen in the configuration ("thread" or "asyncio").
+    def _launch_engine(self):
+        if config["ENGINE"] == "asyncio":
+            import_lazily("asyncio")
+            asyncio.run(self._launch_asyncio())
+        else: self._launch_threads()
+
+    # Handler of SIGTERM, interrupting the server (or a worker process) as Ctrl+C would.
+    def _interrupt_server(self, signal_number, stack_frame): raise KeyboardInterrupt()
+
+    # Handler of SIGHUP, restarting the server: the new server is started by a separate thread, so this one keeps
+    # serving robots until the new one is ready.
+    def _restart_server(self, signal_number=None, stack_frame=None):
+        if self.server_draining or self.server_restarting: return
+
+        self.server_restarting = True
+        start_thread(self._start_successor, daemon=True)
+
+    # Signals interrupting this process: Ctrl+C is handled by the supervisor only, which then interrupts every worker
+    # exactly once with SIGTERM.
+    def _get_interrupt_signals(self):
+        return [signal.SIGTERM] if self.worker_number is not None else [signal.SIGINT, signal.SIGTERM]
+
+    # Reporting to the replaced server (if any) that this one serves robots. Only the first worker reports in the
+    # SO_REUSEPORT mode, once it binds the port; other processes just close the pipe.
+    def _report_ready(self, ready=True):
+        if self.ready_fd is None: return
 
-    # Function responsible for connecting new clients. When a new robot client connects, a new thread
-    # is created specifically to serve it. As the client has no impact on any server configuration data or variables,
-    # there are no critical sections that need to be protected. Therefore, this approach of creating separate threads
-    # to serve each specific client is a suitable and convenient implementation method.
-    def launch(self):
         try:
-            while True:
-                new_robot_socket, new_robot_address = self.server_socket.accept()
-                new_robot_connection = ConnectionMechanism(new_robot_socket, new_robot_address)
-                new_robot_connection_thread = Thread(target=new_robot_connection.create_connection)
-                new_robot_connection_thread.start()
+            if ready: os.write(self.ready_fd, b"\x01")
+        except OSError: pass
+        os.close(self.ready_fd)
+        self.ready_fd = None
+
+    # Starting the server replacing this one, passing it the listening sockets (in the SO_REUSEPORT mode,
+    # its workers bind the port beside the workers of this one) and waiting until it reports it serves robots.
+    # As the new server launches its own stats interface, the one of this server is stopped meanwhile.
+    # Once the new server took over, this one is interrupted (SIGTERM) and drains; otherwise it keeps serving.
+    def _start_successor(self):
+        self._stop_stats()
+        import_lazily("subprocess")
+
+        ready_reader, ready_writer = os.pipe()
+        server_fds = [server_socket.fileno() for server_socket in self.server_sockets]
+        successor_env = {"ROBOT_SERVER_READY_FD": str(ready_writer), "ROBOT_SERVER_FD": ",".join(map(str, server_fds))}
+        successor = None
+        try:
+            successor = subprocess.Popen([sys.executable, *sys.orig_argv[1:]], pass_fds=[ready_writer, *server_fds],
+                                         env={**os.environ, **successor_env})
+            os.close(ready_writer)
+            successor_ready = select.select([ready_reader], [], [], config["RESTART_TIMEOUT"])[0] \
+                and os.read(ready_reader, 1) == b"\x01"
+        except OSError: successor_ready = False
+        finally:
+            if successor is None: os.close(ready_writer)
+            os.close(ready_reader)
+
+        if successor_ready:
+            logger.info(None, "server", 3, f"(PID: {successor.pid})")
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+        if successor is not None: successor.kill(), successor.wait()
+        logger.warning(None, "server", 4)
+        self._launch_stats()
+        self.server_restarting = False
+
+    # Starting to drain the server: no further connections are accepted, and the sessions being served are given
+    # DRAIN_TIMEOUT seconds to finish, after which every one of them is logged out (sent SERVER_LOGOUT) and closed
+    # at its next receive.
+    def _start_draining(self):
+        self.server_draining = True
+        for server_socket in self.server_sockets: server_socket.close()
+        session_timers.drain(config["DRAIN_TIMEOUT"])
+        logger.info(None, "server", 2, f"(TIMEOUT: {config['DRAIN_TIMEOUT']})")
+
+    # Entry point of a worker process: serving robots until the worker is interrupted (and drained).
+    def _launch_worker(self, worker_number):
+        self.worker_number = worker_number
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._interrupt_server)
+        if hasattr(signal, "SIGHUP"): signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if hasattr(signal, "pthread_sigmask"): signal.pthread_sigmask(signal.SIG_UNBLOCK, server_signals)
+        logger.start(forked=True)
+        server_metrics.use_slot(worker_number)
+        if not self.server_sockets: self.server_sockets = self._create_server_sockets()
+        self._report_ready(worker_number == 0)
+        logger.info(None, "worker", 0, f"(PID: {multiprocessing.current_process().pid})")
+
+        self._start_recording()
+        try: self._launch_engine()
+        except KeyboardInterrupt: pass
+        for server_socket in self.server_sockets: server_socket.close()
+        self._log_obstacles_cache()
+        self._stop_recording()
+        logger.stop()
+
+    # Starting (or restarting) the worker process with the given number. Workers are forked, so the inherited
+    # listening socket and configuration are shared without pickling.
+    def _start_worker(self, worker_number):
+        worker = multiprocessing.get_context("fork").Process(target=self._launch_worker, args=(worker_number,),
+                                                             daemon=True)
+        worker.start()
+        self.workers[worker_number] = worker
+
+    # Starting the worker processes with the given numbers. The supervisor forks only while it runs no other thread,
+    # as a lock held by another thread at the fork (such as the one of the standard output held by the log writer)
+    # would stay held forever in the worker: the log writer and the stats interface are stopped meanwhile,
+    # and the signals of the server are blocked, so no restart (see _restart_server) starts a thread either.
+    def _start_workers(self, worker_numbers):
+        signals_blockable = hasattr(signal, "pthread_sigmask")
+        if signals_blockable: signal.pthread_sigmask(signal.SIG_BLOCK, server_signals)
+        stats_relaunched = self.stats_server is not None
+        self._stop_stats()
+        logger.stop()
+        try:
+            for worker_number in worker_numbers: self._start_worker(worker_number)
+        finally:
+            logger.start()
+            self._launch_stats(stats_relaunched)
+            if signals_blockable: signal.pthread_sigmask(signal.SIG_UNBLOCK, server_signals)
+
+    # Function of the supervisor, keeping the configured number of workers alive: whenever a worker process ends,
+    # it is reported and replaced by a new one after WORKERS_RESTART_DELAY seconds, a delay doubled for every further
+    # end of the worker with the same number within WORKERS_RESTART_WINDOW seconds. A worker ending more than
+    # WORKERS_RESTART_LIMIT times within the window (such as one failing to bind its port) is not restarted,
+    # the supervisor returns instead. No worker is restarted while the server is being replaced (see _start_successor).
+    def _launch_supervisor(self):
+        import_lazily("multiprocessing", "multiprocessing.connection")
+        self._start_workers(range(config["WORKERS"]))
+        self._report_ready(False)
+        worker_restarts, worker_ends = {}, {}
 
-        except KeyboardInterrupt: print(f"\n{ui['server'][1]}\n\n")
-        self.server_socket.close()
+        while True:
+            restart_time = time.monotonic()
+            restarted_workers = [] if self.server_restarting else \
+                [worker_number for worker_number, start_time in worker_restarts.items() if start_time <= restart_time]
+            if restarted_workers: self._start_workers(restarted_workers)
+            for worker_number in restarted_workers: del worker_restarts[worker_number]
+
+            wait_timeout = max(min(worker_restarts.values()) - time.monotonic(), config["TIMER_RESOLUTION"]) \
+                if worker_restarts else None
+            multiprocessing.connection.wait([worker.sentinel for worker in self.workers.values()], wait_timeout)
+            for worker_number, worker in list(self.workers.items()):
+                if worker.is_alive(): continue
+
+                del self.workers[worker_number]
+                end_time = time.monotonic()
+                end_count, window_start = worker_ends.get(worker_number, (0, end_time))
+                if end_time - window_start > config["WORKERS_RESTART_WINDOW"]: end_count, window_start = 0, end_time
+                worker_ends[worker_number] = (end_count + 1, window_start)
+                if end_count >= config["WORKERS_RESTART_LIMIT"]:
+                    logger.warning(None, "worker", 3, f"(PID: {worker.pid}, EXIT CODE: {worker.exitcode}, "
+                                                      f"ENDS: {end_count + 1})")
+                    return
+
+                restart_delay = config["WORKERS_RESTART_DELAY"] * 2 ** end_count
+                worker_restarts[worker_number] = end_time + restart_delay
+                logger.warning(None, "worker", 1, f"(PID: {worker.pid}, EXIT CODE: {worker.exitcode}, "
+                                                  f"DELAY: {restart_delay})")
+
+    # Logging the counters of the obstacles cache of this process, if the cache is enabled.
+    def _log_obstacles_cache(self):
+        obstacles_cache = ConnectionMechanism.obstacles_cache
+        if obstacles_cache is not None:
+            logger.info(None, "cache", None, f"(HITS: {obstacles_cache.hits}, MISSES: {obstacles_cache.misses})")
+
+    # Starting the log of the session recorder in this process, if the recorder is enabled.
+    def _start_recording(self):
+        if ServerEngine.session_recorder is not None: ServerEngine.session_recorder.open()
+
+    # Closing the log of the session recorder of this process. Sessions still being served are not recorded further.
+    def _stop_recording(self):
+        if ServerEngine.session_recorder is not None: ServerEngine.session_recorder.close()
+
+    # Interrupting all worker processes and waiting for them to drain and end, killing those that do not end in time.
+    def _shut_down_workers(self):
+        for worker in self.workers.values(): worker.terminate()
+        for worker in self.workers.values():
+            worker.join(config["DRAIN_TIMEOUT"] + config["WORKERS_SHUTDOWN_TIMEOUT"])
+            if worker.is_alive(): worker.kill(), worker.join()
+            logger.info(None, "worker", 2, f"(PID: {worker.pid})")
+
+    # Launching the stats interface (if configured) serving the metrics of the server over HTTP.
+    # It runs in a thread of the supervisor, exporting the metrics of all workers together. Requests are given
+    # TIMEOUT seconds, so stopping the interface (which waits for the requests being answered) never hangs.
+    # An interface relaunched after the supervisor forked workers (see _start_workers) is not logged again.
+    def _launch_stats(self, relaunched=False):
+        if not config["STATS_PORT"]: return
+
+        import_lazily("http.server")
+        stats_handler = type("StatsRequestHandler", (StatsRequestHandler, http.server.BaseHTTPRequestHandler),
+                             {"timeout": config["TIMEOUT"]})
+        self.stats_server = http.server.ThreadingHTTPServer((config["STATS_IP"], config["STATS_PORT"]), stats_handler)
+        self.stats_server.daemon_threads = False
+        start_thread(self.stats_server.serve_forever, daemon=True)
+        if not relaunched: logger.info(None, "stats", None, f"(IP: {config['STATS_IP']}, PORT: {config['STATS_PORT']})")
+
+    def _stop_stats(self):
+        if self.stats_server is None: return
+
+        self.stats_server.shutdown()
+        self.stats_server.server_close()
+        self.stats_server = None
+
+    # Launching the server until it is interrupted: directly in this process for a single worker,
+    # or as the supervisor of the worker processes otherwise, which starts its threads only once it forked the workers
+    # (see _start_workers). The engine drains the server itself, the supervisor drains it by interrupting the workers.
+    # The server exits with status 1 when the supervisor gives up restarting a worker.
+    def launch(self):
+        signal.signal(signal.SIGTERM, self._interrupt_server)
+        if hasattr(signal, "SIGHUP"): signal.signal(signal.SIGHUP, self._restart_server)
+        # A server started by the server it replaces inherits the signals blocked by the thread which started it.
+        if hasattr(signal, "pthread_sigmask"): signal.pthread_sigmask(signal.SIG_UNBLOCK, server_signals)
+        if config["WORKERS"] == 1: logger.start(), self._launch_stats()
+        server_failed = False
+        try:
+            if not self._reuse_port(): self._report_ready()
+            if config["WORKERS"] > 1:
+                self._launch_supervisor()
+                server_failed = True
+            else:
+                self._start_recording()
+                self._launch_engine()
+
+        except KeyboardInterrupt: pass
+        if not self.server_draining: self._start_draining()
+        self._shut_down_workers()
+        logger.info(None, "server", 1)
+        for server_socket in self.server_sockets: server_socket.close()
+        if config["WORKERS"] == 1: self._log_obstacles_cache(), self._stop_recording()
+        self._stop_stats()
+        logger.stop()
+        if server_failed: sys.exit(1)
+
+
+# Validating the given settings of the server (see config_types, config_positive and config_choices), returning them
+# with the key ids of config["AUTH_KEYS"] as numbers (keys of a configuration file are strings), or raising ValueError
+# describing the first invalid setting. The keys file of config["AUTH_KEYS_FILE"] is loaded and checked too,
+# so a missing or malformed file stops the server at startup rather than at its first robot.
+def validate_config(settings):
+    validated_settings = {}
+    for key, value in settings.items():
+        if key not in config: raise ValueError(f"unknown setting {key}")
+        value_types = config_types[key]
+        if type(value) not in value_types:
+            raise ValueError(f"{key} must be {' or '.join(value_type.__name__ for value_type in value_types)}, "
+                             f"not {json.dumps(value)}")
+        if key in config_fixed and value != config[key]: raise ValueError(f"{key} cannot be changed")
+
+        values = value if type(value) is list and key in ("IP", "PORT") else [value]
+        if key in ("IP", "PORT") and (not values or any(type(item) is not value_types[0] for item in values)):
+            raise ValueError(f"{key} must be a non-empty list of {value_types[0].__name__}")
+        if key in ("PORT", "STATS_PORT") and not all(0 <= port <= 65535 for port in values):
+            raise ValueError(f"{key} must be a port number (0-65535)")
+        if type(value) in (int, float) and (value < 0 or value == 0 and key in config_positive):
+            raise ValueError(f"{key} must be {'positive' if key in config_positive else 'non-negative'}")
+        if key in config_choices and value not in config_choices[key]:
+            raise ValueError(f"{key} must be one of {', '.join(config_choices[key])}")
+        if key == "GIFT" and (len(value) != 2 or any(type(coordinate) is not int for coordinate in value)):
+            raise ValueError(f"{key} must be a list of two integer coordinates")
+
+        if key == "AUTH_KEYS":
+            if not check_auth_keys(value): raise ValueError(f"{key} must map key ids to [server key, client key] pairs")
+            value = {int(keyid): key_pair for keyid, key_pair in value.items()}
+        if key == "AUTH_KEYS_FILE" and value:
+            try:
+                with open(value) as keys_file: file_keys = json.load(keys_file)
+            except (OSError, ValueError) as error:
+                raise ValueError(f"{key} {value} cannot be loaded ({error})") from None
+            if not check_auth_keys(file_keys):
+                raise ValueError(f"{key} {value} must map key ids to [server key, client key] pairs")
+
+        validated_settings[key] = value
+
+    return validated_settings
+
+
+# Checking that the authentication keys map key ids (numbers, or their digits as the keys of a JSON object)
+# to [server key, client key] pairs of integers.
+def check_auth_keys(key_pairs):
+    return type(key_pairs) is dict and all(str(keyid).isascii() and str(keyid).isdigit()
+                                           and type(key_pair) is list and len(key_pair) == 2
+                                           and all(type(auth_key) is int for auth_key in key_pair)
+                                           for keyid, key_pair in key_pairs.items())
+
+
+# Reading the settings of the server from a configuration file: a JSON object, or a TOML document for a .toml file
+# (read with tomllib of Python 3.11+).
+def load_config_file(config_path):
+    if config_path.endswith(".toml"):
+        try: import_lazily("tomllib")
+        except ImportError: raise ValueError("TOML configuration files need Python 3.11 or newer") from None
+        with open(config_path, "rb") as config_file: settings = tomllib.load(config_file)
+    else:
+        with open(config_path) as config_file: settings = json.load(config_file)
+
+    if type(settings) is not dict: raise ValueError(f"{config_path} does not contain a table of settings")
+    return settings
+
+
+# The configuration of the server as JSON, printed by --print-config and served by the stats interface on /config.
+# Only the ids of the authentication keys are included, not the keys.
+def dump_config(): return json.dumps({**config, "AUTH_KEYS": sorted(config["AUTH_KEYS"])}, indent=4) + "\n"
+
+
+# Parsing the configuration of the server from the command line: the defaults above are overridden by the settings
+# of the configuration file given in --config, then by the --set overrides and then by the options below. The settings
+# are validated before the server starts (an invalid one ends the program with its error). As the server restarted
+# by SIGHUP runs the same command line, a restart applies the changes of the configuration file.
+def parse_config(arguments=None):
+    import_lazily("argparse")
+    parser = argparse.ArgumentParser(description="TCP server guiding robots to a gift and picking up their messages.")
+    parser.add_argument("--config", dest="CONFIG_FILE", metavar="FILE",
+                        help="JSON (or TOML, with a .toml extension) file with settings of the configuration")
+    parser.add_argument("--set", dest="SETTINGS", action="append", default=[], metavar="KEY=JSON",
+                        help="override any setting of the configuration")
+    parser.add_argument("--ip", dest="IP", nargs="+", metavar="ADDRESS",
+                        help="IPv4 or IPv6 addresses or host names to listen on (empty for all interfaces)")
+    parser.add_argument("--port", dest="PORT", nargs="+", type=int, help="ports to listen on (on every address)")
+    parser.add_argument("--engine", dest="ENGINE", choices=config_choices["ENGINE"])
+    parser.add_argument("--workers", dest="WORKERS", type=int, help="number of worker processes")
+    parser.add_argument("--backlog", dest="BACKLOG", type=int, help="listen backlog of every listening socket")
+    parser.add_argument("--max-sessions", dest="MAX_SESSIONS", type=int, help="robots served at the same time")
+    parser.add_argument("--timeout", dest="TIMEOUT", type=float, metavar="SECONDS")
+    parser.add_argument("--timeout-recharging", dest="TIMEOUT_RECHARGING", type=float, metavar="SECONDS")
+    parser.add_argument("--recv-buffer", dest="RECV_BUFFER", type=int, metavar="BYTES",
+                        help="receive buffer size of the connections (0 for the system default)")
+    parser.add_argument("--send-buffer", dest="SEND_BUFFER", type=int, metavar="BYTES",
+                        help="send buffer size of the connections (0 for the system default)")
+    parser.add_argument("--gift", dest="GIFT", nargs=2, type=int, metavar=("X", "Y"), help="coordinate of the gift")
+    parser.add_argument("--log-level", dest="LOG_LEVEL", choices=config_choices["LOG_LEVEL"])
+    parser.add_argument("--stats-port", dest="STATS_PORT", type=int, help="port of the stats interface (0 for none)")
+    parser.add_argument("--print-config", dest="PRINT_CONFIG", action="store_true",
+                        help="print the resulting configuration as JSON instead of starting the server")
+
+    arguments = vars(parser.parse_args(arguments))
+    try:
+        settings = load_config_file(arguments["CONFIG_FILE"]) if arguments["CONFIG_FILE"] else {}
+        for override in arguments["SETTINGS"]:
+            key, separator, value = override.partition("=")
+            if not separator: raise ValueError(f"--set {override} is not KEY=JSON")
+            try: settings[key] = json.loads(value)
+            except ValueError as error: raise ValueError(f"--set {override}: {error}") from None
+
+        settings.update({key: value for key, value in arguments.items() if key in config and value is not None})
+        settings = validate_config(settings)
+    except (OSError, ValueError) as error: parser.error(str(error))
+
+    if arguments["PRINT_CONFIG"]:
+        config.update(settings)
+        print(dump_config(), end="")
+        parser.exit()
+
+    return settings
 
 
 if __name__ == '__main__':
+    config.update(parse_config())
     server = Server()
     server.launch()
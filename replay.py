@@ -0,0 +1,240 @@
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+import json
+import time
+import os
+
+from main import config, record_events, SessionRecorder, ConnectionMechanism, TimeoutException, \
+    ConnectionException, logger
+
+# Default parameters of the replay.
+replay = {
+    "SPEED": 0,
+    "CONCURRENCY": 1,
+    "REPEAT": 1
+}
+
+# Exceptions ending a recorded session without any data from the client-robot, raised again in the replay
+# after the last recorded part of the stream.
+stream_exceptions = {"TimeoutException": TimeoutException, "ConnectionException": ConnectionException}
+
+# Messages for the user interface of the replay.
+ui = {
+    "replay": "--- Replaying {sessions} sessions at speed {speed} ---",
+    "report": [
+        "sessions:          {sessions} ({mismatched} mismatched)",
+        "duration:          {duration:.2f} s",
+        "sessions/sec:      {sessions_per_second:.1f}",
+        "session p50:       {session_p50:.3f} ms",
+        "session p99:       {session_p99:.3f} ms",
+        "CPU time:          {cpu_per_session:.3f} ms/session"
+    ],
+    "mismatch": "Session {session_id:016x} ({robot_address}) replayed differently: {difference}"
+}
+
+
+# Session read from the log of the session recorder: the address of the client-robot, the timestamped parts
+# of the stream received from it, everything sent to it, the lookups of the obstacles cache that found an obstacle
+# for every route planned (if the cache was enabled) and the way the session ended.
+class RecordedSession:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.robot_address = None
+        self.opened_at = self.closed_at = None
+        self.received = []
+        self.sent = bytearray()
+        self.cached = []
+        self.session_result = None
+
+
+# Reading all records of the given files of the log, in the order of their names (which is the order
+# in which every process wrote them), and grouping them into sessions. Unfinished sessions are left out.
+def read_sessions(record_paths):
+    sessions = {}
+    for record_path in sorted(record_paths):
+        with open(record_path, "rb") as record_file: record_data = record_file.read()
+
+        record_offset = 0
+        while record_offset + SessionRecorder.record_header.size <= len(record_data):
+            session_id, record_time, event, record_length = \
+                SessionRecorder.record_header.unpack_from(record_data, record_offset)
+            if not session_id: break
+
+            record_offset += SessionRecorder.record_header.size
+            record = record_data[record_offset:record_offset + record_length]
+            record_offset += record_length
+
+            session = sessions.setdefault(session_id, RecordedSession(session_id))
+            if event == record_events["OPENED"]: session.robot_address, session.opened_at = record.decode(), record_time
+            elif event == record_events["RECEIVED"]: session.received.append((record_time, record))
+            elif event == record_events["SENT"]: session.sent += record
+            elif event == record_events["CACHED"]: session.cached.append(set(json.loads(record)))
+            elif event == record_events["CLOSED"]:
+                session.session_result, session.closed_at = record.decode(), record_time
+
+    return [session for session in sessions.values() if session.opened_at is not None and session.session_result]
+
+
+# Socket of a replayed session, collecting everything the server sends to the client-robot.
+class ReplaySocket:
+    def __init__(self): self.sent = bytearray()
+
+    def sendmsg(self, robot_buffers):
+        for robot_buffer in robot_buffers: self.sent += robot_buffer
+        return sum(map(len, robot_buffers))
+
+    def setsockopt(self, *socket_option): pass
+
+    def close(self): pass
+
+
+# Stand-in for the obstacles cache in a replayed session, answering every lookup of the routes the session plans
+# as it was answered in the recording (the numbers of the lookups that found an obstacle are recorded for every
+# route), so the session plans the recorded routes whatever other sessions, or other workers, put into the cache
+# meanwhile. The corrections of the cache are ignored.
+class RecordedObstaclesCache:
+    def __init__(self, cached_lookups):
+        self.cached_lookups = cached_lookups
+        self.planned_routes = self.route_lookups = 0
+
+    def contains(self, cell):
+        self.route_lookups += 1
+        return self.planned_routes < len(self.cached_lookups) \
+            and self.route_lookups - 1 in self.cached_lookups[self.planned_routes]
+
+    def add(self, cell): pass
+
+    def discard(self, cell): pass
+
+    # Moving on to the lookups of the next route once a route is planned.
+    def count_lookups(self, hits, misses):
+        self.planned_routes += 1
+        self.route_lookups = 0
+
+
+# Session of the server replaying a recorded one, with an obstacles cache of its own: the recorded lookups
+# for a session recorded with the cache, none otherwise.
+class ReplayConnection(ConnectionMechanism):
+    __slots__ = ("obstacles_cache",)
+
+    def __init__(self, robot_socket, robot_address, cached_lookups):
+        super().__init__(robot_socket, robot_address)
+        self.obstacles_cache = RecordedObstaclesCache(cached_lookups) if cached_lookups else None
+
+
+# Runner of the replay: every recorded session is fed back through a session of the server
+# (see ReplayConnection and ConnectionMechanism.replay_connection) at the original pace multiplied by SPEED, or as fast
+# as possible with SPEED 0, and everything the server sends is compared with the recorded packets. The sessions
+# are replayed by CONCURRENCY threads, REPEAT times over, so the replay doubles as a realistic workload.
+class ReplayRunner:
+    def __init__(self, settings):
+        self.settings = settings
+
+    # Parts of the recorded stream, each given when it is due at the replay speed, followed by the exception
+    # which ended the recorded session, if it ended without any data from the client-robot.
+    def _replay_stream(self, session, started_at):
+        for record_time, robot_data_part in session.received:
+            self._wait_until(started_at, record_time - session.opened_at)
+            yield robot_data_part
+
+        if session.session_result in stream_exceptions:
+            self._wait_until(started_at, session.closed_at - session.opened_at)
+            raise stream_exceptions[session.session_result]()
+
+    # Waiting until the given delay after the start of the recorded session passes at the replay speed.
+    def _wait_until(self, started_at, record_delay):
+        if not self.settings["SPEED"]: return
+        time.sleep(max(0, started_at + record_delay / self.settings["SPEED"] - time.perf_counter()))
+
+    # Replaying one session, returning its duration and the difference from the recording (or None).
+    def _replay_session(self, session):
+        replay_socket = ReplaySocket()
+        robot_address = tuple(session.robot_address.rsplit(":", 1))
+        started_at = time.perf_counter()
+
+        robot_connection = ReplayConnection(replay_socket, robot_address, session.cached)
+        robot_connection.replay_connection(self._replay_stream(session, started_at))
+        duration = time.perf_counter() - started_at
+
+        if robot_connection.session_result != session.session_result:
+            return duration, f"ended with {robot_connection.session_result} instead of {session.session_result}"
+        if replay_socket.sent != session.sent:
+            return duration, f"sent {bytes(replay_socket.sent)!r} instead of {bytes(session.sent)!r}"
+
+        return duration, None
+
+    # Replaying all recorded sessions, printing the report and the first mismatched sessions, and optionally
+    # appending the report as a JSON line to a file to track it across commits.
+    def run(self):
+        config.update(self.settings["SERVER_CONFIG"])
+        ConnectionMechanism.configure()
+        config["LOG_LEVEL"] = "DEBUG" if self.settings["VERBOSE"] else "OFF"
+        logger.start()
+
+        sessions = read_sessions(self.settings["RECORD_FILES"]) * self.settings["REPEAT"]
+        print(ui["replay"].format(sessions=len(sessions), speed=self.settings["SPEED"] or "max"))
+
+        started_at, started_cpu = time.perf_counter(), time.process_time()
+        with ThreadPoolExecutor(self.settings["CONCURRENCY"]) as executor:
+            results = list(executor.map(self._replay_session, sessions))
+        duration, cpu = time.perf_counter() - started_at, time.process_time() - started_cpu
+        logger.stop()
+
+        mismatched = [(session, difference) for session, (_, difference) in zip(sessions, results) if difference]
+        for session, difference in mismatched[:10]:
+            print(ui["mismatch"].format(session_id=session.session_id, robot_address=session.robot_address,
+                                        difference=difference))
+
+        durations = sorted(session_duration * 1000 for session_duration, _ in results) or [0]
+        percentile = lambda p: durations[min(len(durations) - 1, int(len(durations) * p / 100))]
+        report = {
+            "sessions": len(sessions), "mismatched": len(mismatched), "duration": duration,
+            "sessions_per_second": len(sessions) / duration if duration else 0,
+            "session_p50": percentile(50), "session_p99": percentile(99),
+            "cpu_per_session": cpu * 1000 / max(len(sessions), 1)
+        }
+        print("\n".join(line.format(**report) for line in ui["report"]) + "\n")
+
+        if self.settings["JSON"]:
+            with open(self.settings["JSON"], "a") as json_file:
+                json_file.write(json.dumps({**report, "time": time.time()}) + "\n")
+
+        return report
+
+
+# Parsing the parameters of the replay from the command line.
+def parse_settings(arguments=None):
+    parser = ArgumentParser(description="Deterministic replay of the sessions recorded by the robot server.")
+    parser.add_argument("RECORD_FILES", nargs="+",
+                        help="files of the session recorder, or directories (RECORD_DIR) containing them")
+    parser.add_argument("--speed", dest="SPEED", type=float, default=replay["SPEED"],
+                        help="multiple of the original pace (1 is the original pace, 0 as fast as possible)")
+    parser.add_argument("--concurrency", dest="CONCURRENCY", type=int, default=replay["CONCURRENCY"])
+    parser.add_argument("--repeat", dest="REPEAT", type=int, default=replay["REPEAT"],
+                        help="replay every session this many times")
+    parser.add_argument("--set", dest="SERVER_CONFIG", action="append", default=[], metavar="KEY=JSON",
+                        help="override a value of the server configuration (the values shaping the replies, "
+                             "such as PIPELINE, GIFT and AUTH_KEYS, must be the recording ones)")
+    parser.add_argument("--json", dest="JSON", help="append the report as a JSON line to this file")
+    parser.add_argument("--verbose", dest="VERBOSE", action="store_true", help="show the output of the server")
+
+    settings = vars(parser.parse_args(arguments))
+    settings["SERVER_CONFIG"] = {key: json.loads(value) for key, value in
+                                 (override.split("=", 1) for override in settings["SERVER_CONFIG"])}
+    settings["RECORD_FILES"] = find_record_files(settings["RECORD_FILES"])
+    return settings
+
+
+# Expanding the directories among the given paths into the files of the session recorder they contain.
+def find_record_files(record_paths):
+    record_files = []
+    for record_path in record_paths:
+        if not os.path.isdir(record_path): record_files.append(record_path)
+        else: record_files += [os.path.join(record_path, record_name) for record_name in os.listdir(record_path)
+                               if record_name.endswith(".rec")]
+
+    return record_files
+
+
+if __name__ == '__main__':
+    ReplayRunner(parse_settings()).run()
@@ -0,0 +1,165 @@
+from tempfile import NamedTemporaryFile
+import unittest
+import socket
+import os
+
+from main import config, orientation, orientation_steps, PacketsQueue, ConnectionMechanism, ObstaclesCache, \
+    SyntaxException, validate_config
+
+
+# Tests of the incremental queue of the packets received from a client-robot, fed with the stream in various parts.
+class PacketsQueueTest(unittest.TestCase):
+    def setUp(self): self.packets_queue = PacketsQueue()
+
+    # Feeding the parts of the stream one by one and collecting the packets returned after each of them.
+    def _get_packets(self, packet_parts, packet_length=20):
+        robot_packets = []
+        for packet_part in packet_parts:
+            self.packets_queue.put(packet_part)
+            while (packet := self.packets_queue.get_packet(packet_length)) is not None: robot_packets.append(packet)
+
+        return robot_packets
+
+    def test_whole_packet(self): self.assertEqual(self._get_packets([b"Oompa Loompa\a\b"]), ["Oompa Loompa"])
+
+    def test_tag_split_across_parts(self):
+        self.assertEqual(self._get_packets([b"Oompa Loompa\a"]), [])
+        self.assertEqual(self._get_packets([b"\b"]), ["Oompa Loompa"])
+
+    def test_byte_by_byte(self):
+        packet_parts = [bytes([packet_byte]) for packet_byte in b"Oompa\a\bLoompa\a\b"]
+        self.assertEqual(self._get_packets(packet_parts), ["Oompa", "Loompa"])
+
+    def test_pipelined_packets(self):
+        self.assertEqual(self._get_packets([b"OK 0 1\a\bOK 0 2\a\bOK 0"], 12), ["OK 0 1", "OK 0 2"])
+        self.assertEqual(self._get_packets([b" 3\a\bRECHARGING\a\b"], 12), ["OK 0 3", "RECHARGING"])
+
+    def test_bell_inside_packet(self):
+        self.assertEqual(self._get_packets([b"Oompa\a\a\bLoompa\a\b"]), ["Oompa\a", "Loompa"])
+
+    # A packet of the maximum length whose \a arrives without its \b may still end right there.
+    def test_bell_at_length_limit(self):
+        self.assertEqual(self._get_packets([b"x" * 18 + b"\a"]), [])
+        self.assertEqual(self._get_packets([b"\b"]), ["x" * 18])
+
+    def test_bell_at_length_limit_followed_by_data(self):
+        with self.assertRaises(SyntaxException): self._get_packets([b"x" * 18 + b"\a", b"x"])
+
+    def test_unfinished_packet_too_long(self):
+        with self.assertRaises(SyntaxException): self._get_packets([b"x" * 19])
+
+    def test_packet_too_long(self):
+        with self.assertRaises(SyntaxException): self._get_packets([b"x" * 19 + b"\a\b"])
+
+    def test_undecodable_packet(self):
+        with self.assertRaises(SyntaxException): self._get_packets([b"Oompa \xff\xfe\a\b"])
+
+
+# Tests of the A* search of the route to the gift (at [0, 0]), run by a session over a socket pair.
+class RouteSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.robot_sockets = socket.socketpair()
+        self.robot_connection = ConnectionMechanism(self.robot_sockets[0], ("127.0.0.1", 0))
+
+    def tearDown(self):
+        for robot_socket in self.robot_sockets: robot_socket.close()
+
+    # Searching the route from the given position and orientation over the given obstacles on the map.
+    def _search_route(self, robot_position, robot_orientation, obstacles=(), obstacles_cache=None):
+        self.robot_connection.robot_position = robot_position
+        self.robot_connection.robot_orientation = orientation.index(robot_orientation)
+        self.robot_connection.robot_map = {cell: True for cell in obstacles}
+        self.robot_connection.cache_hits, self.robot_connection.cache_misses = [], 0
+        return self.robot_connection._search_robot_route(obstacles_cache)
+
+    # Following the route from the given position and orientation, checking it avoids the obstacles and ends
+    # on the gift.
+    def _assert_route_to_gift(self, robot_route, robot_position, robot_orientation, obstacles=()):
+        robot_orientation = orientation.index(robot_orientation)
+        for command in robot_route:
+            if command == "SERVER_TURN_RIGHT": robot_orientation = (robot_orientation + 1) % len(orientation)
+            elif command == "SERVER_TURN_LEFT": robot_orientation = (robot_orientation - 1) % len(orientation)
+            else:
+                step = orientation_steps[robot_orientation]
+                robot_position = (robot_position[0] + step[0], robot_position[1] + step[1])
+                self.assertNotIn(robot_position, obstacles)
+
+        self.assertEqual(robot_position, tuple(config["GIFT"]))
+
+    def test_robot_on_gift(self): self.assertEqual(self._search_route((0, 0), "DOWN"), [])
+
+    def test_straight_route(self):
+        self.assertEqual(self._search_route((2, 0), "LEFT"), ["SERVER_MOVE", "SERVER_MOVE"])
+
+    def test_route_with_turn(self):
+        self.assertEqual(self._search_route((0, -2), "RIGHT"), ["SERVER_TURN_LEFT", "SERVER_MOVE", "SERVER_MOVE"])
+
+    # Going around an obstacle takes 4 steps and 3 turns, however the robot goes around.
+    def test_route_around_obstacle(self):
+        robot_route = self._search_route((0, -2), "UP", [(0, -1)])
+        self.assertEqual(len(robot_route), 7)
+        self._assert_route_to_gift(robot_route, (0, -2), "UP", [(0, -1)])
+
+    def test_route_through_maze(self):
+        obstacles = [(x, 1) for x in range(-3, 4)] + [(3, y) for y in range(-3, 2)] + [(x, -1) for x in range(-1, 3)]
+        robot_route = self._search_route((2, 3), "DOWN", obstacles)
+        self._assert_route_to_gift(robot_route, (2, 3), "DOWN", obstacles)
+
+    def test_enclosed_gift(self):
+        self.assertIsNone(self._search_route((2, 2), "UP", [(0, 1), (1, 0), (0, -1), (-1, 0)]))
+
+    # Cells of the obstacles cache are avoided like the cells of the map, and the lookups that hit are kept.
+    def test_route_around_cached_obstacle(self):
+        obstacles_cache = ObstaclesCache(64)
+        obstacles_cache.add((0, -1))
+        robot_route = self._search_route((0, -2), "UP", obstacles_cache=obstacles_cache)
+        self._assert_route_to_gift(robot_route, (0, -2), "UP", [(0, -1)])
+        self.assertEqual(len(robot_route), 7)
+        self.assertTrue(self.robot_connection.cache_hits)
+
+
+# Tests of the validation of the settings of the server.
+class ValidateConfigTest(unittest.TestCase):
+    def test_valid_settings(self):
+        settings = {"IP": ["127.0.0.1", "::1"], "PORT": [4321, 4322], "WORKERS": 4, "TIMEOUT": 0.5,
+                    "DRAIN_TIMEOUT": 3, "ENGINE": "asyncio", "GIFT": [1, -1], "PROTOCOL_TAG": config["PROTOCOL_TAG"]}
+        self.assertEqual(validate_config(settings), settings)
+
+    def test_auth_keys_ids(self):
+        self.assertEqual(validate_config({"AUTH_KEYS": {"7": [1, 2]}}), {"AUTH_KEYS": {7: [1, 2]}})
+
+    def test_invalid_settings(self):
+        invalid_settings = [
+            ({"PORTS": 4321}, "unknown setting"),
+            ({"WORKERS": "4"}, "WORKERS must be int"),
+            ({"WORKERS": True}, "WORKERS must be int"),
+            ({"WORKERS": 0}, "WORKERS must be positive"),
+            ({"BACKLOG": -1}, "BACKLOG must be non-negative"),
+            ({"TIMEOUT": 0}, "TIMEOUT must be positive"),
+            ({"ENGINE": "trio"}, "ENGINE must be one of"),
+            ({"PROTOCOL_TAG": "\r\n"}, "PROTOCOL_TAG cannot be changed"),
+            ({"PORT": []}, "PORT must be a non-empty list"),
+            ({"PORT": [4321, "4322"]}, "PORT must be a non-empty list"),
+            ({"PORT": 70000}, "PORT must be a port number"),
+            ({"GIFT": [1]}, "GIFT must be a list of two integer coordinates"),
+            ({"AUTH_KEYS": {"a": [1, 2]}}, "AUTH_KEYS must map key ids"),
+            ({"AUTH_KEYS": {"1": [1]}}, "AUTH_KEYS must map key ids")
+        ]
+        for settings, error in invalid_settings:
+            with self.subTest(settings=settings), self.assertRaisesRegex(ValueError, error): validate_config(settings)
+
+    def test_auth_keys_file(self):
+        with NamedTemporaryFile("w", suffix=".json", delete=False) as keys_file: keys_file.write('{"0": [1, 2]}')
+        try:
+            self.assertEqual(validate_config({"AUTH_KEYS_FILE": keys_file.name}), {"AUTH_KEYS_FILE": keys_file.name})
+            with open(keys_file.name, "w") as keys_file_writer: keys_file_writer.write('{"0": [1]}')
+            with self.assertRaisesRegex(ValueError, "must map key ids"):
+                validate_config({"AUTH_KEYS_FILE": keys_file.name})
+        finally: os.remove(keys_file.name)
+
+    def test_missing_auth_keys_file(self):
+        with self.assertRaisesRegex(ValueError, "cannot be loaded"): validate_config({"AUTH_KEYS_FILE": "/nonexistent"})
+
+
+if __name__ == '__main__':
+    unittest.main()